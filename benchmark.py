@@ -0,0 +1,342 @@
+#!/usr/bin/env python2
+
+# Micro-benchmarks for the data pipeline. Run from the project root with
+#
+#     PYTHONPATH=src python benchmark.py <benchmark> [config]
+
+from channels import GaussianChannel
+from experience import Experience, Episode
+import experience
+from models import RecurrentQModel
+from util import Struct
+import tasks
+from tasks.drive import DriveState, TEMPLATES
+from tests.test_drive import grid_step
+from workers import RolloutWorkers
+
+import copy
+import multiprocessing
+import numpy as np
+import sys
+import tensorflow as tf
+import time
+import yaml
+
+N_REPEATS = 20
+
+random = np.random.RandomState(0)
+
+def load_config(path):
+    with open(path) as config_f:
+        return Struct(**yaml.load(config_f))
+
+def timed(fn, n_repeats=N_REPEATS):
+    start = time.time()
+    for _ in range(n_repeats):
+        out = fn()
+    return (time.time() - start) / n_repeats, out
+
+def report(name, legacy_time, new_time, labels=("legacy", "new")):
+    print "%-20s %s %8.2fms  %s %8.2fms  speedup %5.1fx" % (
+            name, labels[0], 1000 * legacy_time, labels[1], 1000 * new_time,
+            legacy_time / new_time)
+
+def random_episodes(task, config, count):
+    episodes = []
+    for _ in range(count):
+        world = task.get_instance("train")
+        episode = []
+        for t in range(config.trainer.n_timeout):
+            actions = tuple(random.randint(n) for n in task.n_actions)
+            memory = tuple(
+                    [random.randn(size) for _ in range(task.n_agents)]
+                    for size in (config.model.n_hidden, config.channel.n_msg,
+                        config.model.n_hidden))
+            world_, reward, done = world.step(actions)
+            done = done or t == config.trainer.n_timeout - 1
+            episode.append(Experience(
+                world, memory, actions, world_, memory, reward, done))
+            world = world_
+            if done:
+                break
+        episodes.append(episode)
+    return episodes
+
+def sample_slices(episodes, config):
+    slices = []
+    for ep in episodes:
+        offset = random.randint(
+                max(1, len(ep) - config.trainer.n_batch_history))
+        slices.append(ep[offset:offset+config.trainer.n_batch_history])
+    return slices
+
+def legacy_replay_feed(episodes, task, config):
+    n_batch = len(episodes)
+    n_history = config.trainer.n_batch_history
+    reward = np.zeros((n_batch, n_history))
+    terminal = np.zeros((n_batch, n_history))
+    mask = np.zeros((n_batch, n_history))
+    x = [np.zeros((n_batch, n_history, task.n_features))
+            for _ in range(task.n_agents)]
+    x_next = [np.zeros((n_batch, n_history, task.n_features))
+            for _ in range(task.n_agents)]
+    h = [np.zeros((n_batch, config.model.n_hidden))
+            for _ in range(task.n_agents)]
+    action = [np.zeros((n_batch, n_history, task.n_actions[i_agent]))
+            for i_agent in range(task.n_agents)]
+    l_msg = [np.zeros((n_batch, n_history, len(task.lexicon)))
+            for _ in range(task.n_agents)]
+    for i in range(n_batch):
+        ep = episodes[i]
+        for i_agent in range(task.n_agents):
+            if ep[0].m1 is not None:
+                h[i_agent][i, :] = ep[0].m1[0][i_agent]
+        for j in range(len(ep)):
+            reward[i, j] = ep[j].r
+            terminal[i, j] = ep[j].t
+            mask[i, j] = 1
+            for i_agent in range(task.n_agents):
+                x[i_agent][i, j, :] = ep[j].s1.obs()[i_agent]
+                x_next[i_agent][i, j, :] = ep[j].s2.obs()[i_agent]
+                action[i_agent][i, j, ep[j].a[i_agent]] = 1
+                l_msg[i_agent][i, j, :] = ep[j].s1.l_msg[i_agent]
+    return reward, terminal, mask, x, x_next, h, action, l_msg
+
+def bench_replay(task, config):
+    replay_ph = experience.ReplayPlaceholders(task, config)
+    raw = random_episodes(task, config, config.trainer.n_batch_episodes)
+    episodes = [Episode(ep) for ep in raw]
+    random.seed(1)
+    raw_slices = sample_slices(raw, config)
+    random.seed(1)
+    slices = sample_slices(episodes, config)
+
+    legacy_time, legacy = timed(
+            lambda: legacy_replay_feed(raw_slices, task, config))
+    new_time, feed = timed(lambda: replay_ph.feed(slices, task, config))
+
+    reward, terminal, mask, x, x_next, h, action, l_msg = legacy
+    assert np.allclose(reward, feed[replay_ph.t_reward])
+    assert np.allclose(terminal, feed[replay_ph.t_terminal])
+    assert np.allclose(mask, feed[replay_ph.t_mask])
+    for i_agent in range(task.n_agents):
+        assert np.allclose(x[i_agent], feed[replay_ph.t_x][i_agent])
+        assert np.allclose(x_next[i_agent], feed[replay_ph.t_x_next][i_agent])
+        assert np.allclose(h[i_agent], feed[replay_ph.t_h][i_agent])
+        assert np.allclose(action[i_agent], feed[replay_ph.t_action][i_agent])
+        assert np.allclose(l_msg[i_agent], feed[replay_ph.t_l_msg][i_agent])
+    report("replay feed", legacy_time, new_time)
+
+def densify(index, value, n_features):
+    dense = np.zeros(index.shape[:-1] + (n_features,))
+    for i in np.ndindex(*index.shape[:-1]):
+        np.add.at(dense[i], index[i], value[i])
+    return dense
+
+def bench_obs(task, config):
+    raw = random_episodes(task, config, config.trainer.n_batch_episodes)
+    episodes = [Episode(ep) for ep in raw]
+    slices = sample_slices(episodes, config)
+    # feed as many worlds as a replay batch so the rollout timing is
+    # measurable
+    worlds = task.get_batch("train", config.trainer.n_batch_episodes)
+    hs, zs, l_hs = (
+            [np.zeros((len(worlds), size))] * task.n_agents
+            for size in (config.model.n_hidden, config.channel.n_msg,
+                config.model.n_hidden))
+
+    times = {}
+    feeds = {}
+    for sparse in (False, True):
+        config.model.sparse_obs = sparse
+        with tf.Graph().as_default():
+            rollout_ph = experience.RolloutPlaceholders(task, config)
+            replay_ph = experience.ReplayPlaceholders(task, config)
+            channel = GaussianChannel()
+            channel.build(config)
+            model = RecurrentQModel()
+            model.build(task, rollout_ph, replay_ph, channel, config)
+            session = tf.Session()
+            session.run(tf.global_variables_initializer())
+
+            rollout_time, rollout_feed = timed(lambda: rollout_ph.feed(
+                    hs, zs, l_hs, worlds, task, config))
+            replay_time, replay_feed = timed(
+                    lambda: replay_ph.feed(slices, task, config))
+            forward_time, _ = timed(lambda: session.run(
+                    model.tt_rollout_q, rollout_feed))
+            train_time, _ = timed(lambda: session.run(
+                    model.t_train_op, replay_feed))
+            session.close()
+        times[sparse] = (rollout_time, replay_time, forward_time, train_time)
+        feeds[sparse] = (replay_ph, replay_feed)
+
+    dense_ph, dense_feed = feeds[False]
+    sparse_ph, sparse_feed = feeds[True]
+    for t_dense, t_sparse in (
+            (dense_ph.t_x, sparse_ph.t_x_sparse_flat),
+            (dense_ph.t_x_next, sparse_ph.t_x_next_sparse_flat)):
+        dense = dense_feed[t_dense]
+        sparse = sparse_feed[t_sparse]
+        for i_agent in range(task.n_agents):
+            x = densify(sparse[2 * i_agent], sparse[2 * i_agent + 1],
+                    task.n_features)
+            assert np.allclose(x, dense[i_agent])
+    index, value = worlds.obs_indices()
+    for i_agent, obs in enumerate(worlds.obs()):
+        x = densify(index[:, i_agent], value[:, i_agent], task.n_features)
+        assert np.allclose(x, obs)
+
+    labels = ("dense", "sparse")
+    report("rollout feed", times[False][0], times[True][0], labels)
+    report("replay feed", times[False][1], times[True][1], labels)
+    report("rollout forward", times[False][2], times[True][2], labels)
+    report("train step", times[False][3], times[True][3], labels)
+
+# times every recorded drive trace, plus random actions from the same states
+# to reach crashes and off-road moves the logs may not contain, against the
+# grid reference that tests/test_drive.py checks DriveState.step with
+def bench_step(task, config):
+    transitions = [
+            (e.s1, e.a)
+            for ep in task.train_demonstrations + task.test_demonstrations
+            for e in ep]
+    transitions += [
+            (s1, tuple(random.randint(4, size=task.n_agents)))
+            for s1, _ in transitions]
+
+    legacy_time, _ = timed(
+            lambda: [grid_step(s1, a) for s1, a in transitions], 5)
+    new_time, _ = timed(lambda: [s1.step(a) for s1, a in transitions], 5)
+    report("drive step", legacy_time / len(transitions),
+            new_time / len(transitions))
+
+def legacy_distractors_for(task, state, obs_agent, n_samples):
+    random = task.randoms["val"]
+    out = []
+    for _ in range(n_samples):
+        pos = None
+        while pos is None:
+            pos = (random.randint(state.road.shape[0]),
+                        random.randint(state.road.shape[1]))
+            if not state.road[pos]:
+                pos = None
+        inst = task.get_instance("val", state.map_id)
+        cars = []
+        for i_car, car in enumerate(state.cars):
+            if i_car == obs_agent:
+                cars.append(state.cars[i_car])
+            else:
+                cars.append(inst.cars[i_car]._replace(pos=pos, dir=random.randint(4)))
+        out.append((DriveState(state.map_id, state.road, cars), 1))
+    return out
+
+def legacy_distractor_obs(task, states, obs_agent, n_samples):
+    return np.asarray([
+            [dis.obs() for dis, _ in
+                legacy_distractors_for(task, state, obs_agent, n_samples)]
+            for state in states])
+
+# the draws differ from the legacy rejection sampler, so the check is on
+# structure and on the distribution of distractor cars per map
+def bench_distractors(task, config):
+    obs_agent = 1
+    n_samples = config.trainer.n_distractors
+    states = [e.s1 for ep in task.train_demonstrations for e in ep]
+    states = states[:config.trainer.n_batch_episodes]
+
+    legacy_time, legacy = timed(lambda: legacy_distractor_obs(
+            task, states, obs_agent, n_samples))
+    new_time, new = timed(lambda: task._make_distractor_obs(
+            states, obs_agent, n_samples))
+    assert new.shape == legacy.shape
+    for state, dis_obs in zip(states, new):
+        for obs in dis_obs:
+            assert np.array_equal(obs[obs_agent], state.obs()[obs_agent])
+    dis_states = [dis for state in states
+            for dis, _ in task.distractors_for(state, obs_agent, n_samples)]
+    for dis in dis_states:
+        fresh = DriveState(dis.map_id, dis.road, dis.cars)
+        assert np.array_equal(np.asarray(dis.obs()), np.asarray(fresh.obs()))
+        car = dis.cars[1 - obs_agent]
+        assert dis.road[car.pos] and not car.done
+        assert car.goal in TEMPLATES[dis.map_id].goals
+
+    n_draws = 20000
+    for state in states[:1]:
+        legacy_obs = legacy_distractor_obs(task, [state], obs_agent, n_draws)
+        new_obs = task._make_distractor_obs([state], obs_agent, n_draws)
+        legacy_freq = legacy_obs[0, :, 1 - obs_agent].mean(axis=0)
+        new_freq = new_obs[0, :, 1 - obs_agent].mean(axis=0)
+        # each car has four one-hot blocks
+        assert np.abs(legacy_freq - new_freq).sum() / 4 < 0.05
+    report("distractor obs", legacy_time, new_time)
+
+N_WORKER_WORLDS = 20000
+
+# random actions for n_worlds worlds over a whole episode
+def worker_rollout(make_batch, actions):
+    batch = make_batch()
+    rewards = []
+    for step_actions in actions:
+        batch.obs_indices()
+        reward, _ = batch.step(step_actions)
+        rewards.append(reward)
+    return np.stack(rewards, axis=1), batch.states()
+
+# workers can only win with a core each; the baseline is the single
+# in-process DriveBatch that n_workers: 0 uses
+def bench_workers(task, config):
+    n_workers = max(2, config.trainer.n_workers, multiprocessing.cpu_count())
+    actions = random.randint(
+            4, size=(config.trainer.n_timeout, N_WORKER_WORLDS, task.n_agents))
+    sizes = [N_WORKER_WORLDS // n_workers + (i < N_WORKER_WORLDS % n_workers)
+            for i in range(n_workers)]
+    bounds = np.cumsum([0] + sizes)
+
+    # the same worlds come from copies of the task seeded like the workers
+    def reference_rollout():
+        parts = []
+        for i_worker in range(n_workers):
+            worker_task = copy.copy(task)
+            worker_task.reseed(i_worker + 1)
+            start, end = bounds[i_worker], bounds[i_worker + 1]
+            parts.append(worker_rollout(
+                    lambda: worker_task.get_batch("train", end - start),
+                    actions[:, start:end]))
+        return (np.concatenate([r for r, _ in parts]),
+                [s for _, states in parts for s in states])
+
+    workers = RolloutWorkers(task, n_workers)
+    local_time, _ = timed(lambda: worker_rollout(
+            lambda: task.get_batch("train", N_WORKER_WORLDS), actions), 3)
+    remote_time, (remote_rewards, remote_states) = timed(
+            lambda: worker_rollout(
+                lambda: workers.get_batch("train", N_WORKER_WORLDS), actions),
+            1)
+    workers.close()
+
+    reference_rewards, reference_states = reference_rollout()
+    assert np.array_equal(reference_rewards, remote_rewards)
+    assert ([s.key() for s in reference_states]
+            == [s.key() for s in remote_states])
+    report("worker rollout", local_time, remote_time,
+            ("in-process", "%d workers" % n_workers))
+
+BENCHMARKS = {
+    "replay": bench_replay,
+    "obs": bench_obs,
+    "step": bench_step,
+    "distractors": bench_distractors,
+    "workers": bench_workers,
+}
+
+def main():
+    name = sys.argv[1]
+    config_path = sys.argv[2] if len(sys.argv) > 2 else "configs/drive_train.yaml"
+    config = load_config(config_path)
+    task = tasks.load(config)
+    BENCHMARKS[name](task, config)
+
+if __name__ == "__main__":
+    main()
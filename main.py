@@ -10,6 +10,7 @@ import channels
 import translators
 
 import trainer
+from workers import RolloutWorkers
 import lexicographer
 import visualizer
 import calibrator
@@ -27,8 +28,12 @@ import yaml
 
 def main():
     config = configure()
-    session = tf.Session()
     task = tasks.load(config)
+    # forked before the session exists, so no worker inherits it
+    workers = None
+    if config.task.train and config.trainer.n_workers > 0:
+        workers = RolloutWorkers(task, config.trainer.n_workers)
+    session = tf.Session()
     channel = channels.load(config)
     model = models.load(config)
     desc_model = models.desc_im.DescriptionImitationModel()
@@ -45,7 +50,9 @@ def main():
     if config.task.train:
         trainer.run(
                 task, rollout_ph, replay_ph, reconst_ph, model, desc_model,
-                translator, session, config)
+                translator, session, config, workers)
+        if workers is not None:
+            workers.close()
     else:
         trainer.load(session, config)
 
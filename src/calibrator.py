@@ -1,3 +1,4 @@
+from experience import RolloutStep
 from tasks.ref import RefTask
 import trainer
 
@@ -8,10 +9,12 @@ import tensorflow as tf
 random = np.random.RandomState(5892)
 
 def run(task, rollout_ph, model, desc_model, lexicographer, session, config):
-    h0, z0, _ = session.run(model.zero_state(1, tf.float32))
+    step = RolloutStep(rollout_ph, None, desc_model, session, task, config)
     demonstrations = [
             task.get_demonstration("val") 
             for _ in range(config.trainer.n_batch_episodes)]
+    h0, z0, _ = session.run(
+            model.zero_state(len(demonstrations), tf.float32))
 
     #randomized = []
     #for _ in range(config.trainer.n_batch_episodes):
@@ -28,7 +31,7 @@ def run(task, rollout_ph, model, desc_model, lexicographer, session, config):
     #rollouts = []
     #for _ in range(config.trainer.n_batch_episodes):
     #    trainer._do_rollout(
-    #            task, rollout_ph, model, desc_model, rollouts, [], session,
+    #            task, rollout_ph, model, desc_model, rollouts, session,
     #            config, 10000, h0, z0, fold="val")
 
     speaker_agree = {"human": 0, "random": 0}
@@ -36,23 +39,24 @@ def run(task, rollout_ph, model, desc_model, lexicographer, session, config):
     count = {"human": 0, "random": 0}
 
     for seqs, source in [(demonstrations, "human")]: #, (randomized, "random")]:
-        for ep in seqs:
-            hs = h0
-            for t, transition in enumerate(ep):
-                hs_, scores = session.run(
-                    [desc_model.tt_rollout_h, desc_model.tt_rollout_q],
-                    rollout_ph.feed(h0, z0, hs, [transition.s1], task, config))
-                probs = [np.exp(sc[0, :]) / np.exp(sc[0, :]).sum() for sc in scores]
-                if isinstance(task, RefTask):
-                    if t > 0:
-                        count[source] += 1
-                        if np.argmax(probs[1]) == transition.a[1]:
-                            actor_agree[source] += 1
-                        #actor_agree[source] += probs[1][transition.a[1]]
-                else:
-                    pass
-                    #assert False
-                hs = hs_
+        # all episodes step together; finished ones are padded with their
+        # last transition and masked out of the counts
+        lengths = np.asarray([len(ep) for ep in seqs])
+        hs = h0
+        for t in range(np.max(lengths)):
+            transitions = [ep[min(t, len(ep) - 1)] for ep in seqs]
+            hs, scores = step(
+                    ("l_h", "l_q"), h0, z0, hs, [tr.s1 for tr in transitions])
+            if isinstance(task, RefTask):
+                if t > 0:
+                    active = t < lengths
+                    actions = np.asarray([tr.a[1] for tr in transitions])
+                    agree = np.argmax(scores[1], axis=1) == actions
+                    count[source] += int(np.sum(active))
+                    actor_agree[source] += int(np.sum(active & agree))
+            else:
+                pass
+                #assert False
 
     logging.info("[cal]  \t" + str(actor_agree))
     logging.info("")
@@ -5,7 +5,10 @@ class GaussianChannel(object):
         self.std = config.channel.std
         self.normalize = config.channel.normalize
 
-    def transmit(self, msg):
+    # noise, if given, is standard normal with the shape of msg
+    def transmit(self, msg, noise=None):
         if self.normalize:
             msg = tf.nn.l2_normalize(msg, 1)
-        return msg + tf.random_normal(tf.shape(msg), stddev=self.std)
+        if noise is None:
+            noise = tf.random_normal(tf.shape(msg))
+        return msg + self.std * noise
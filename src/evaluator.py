@@ -1,103 +1,106 @@
-from experience import Experience
+from experience import RolloutStep, StateBatch
 from tasks.ref import RefTask
 import trainer
 
+import copy
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import tensorflow as tf
+import time
 
-random = np.random.RandomState(4813)
+# each episode draws its channel noise and any other choices from its own
+# stream, so results don't depend on how the episodes are split into batches
+SEED = 4813
+
+# normal quantile for 95% confidence intervals
+Z_95 = 1.96
+# a few episodes can all fail (or succeed) and give a zero-width interval, so
+# never stop on the interval width before this many
+MIN_EPISODES = 100
+
+def _episode_randoms(first_episode, n_episodes):
+    return [
+            np.random.RandomState((SEED, first_episode + i))
+            for i in range(n_episodes)]
 
 def _do_deaf_rollout(
         code_agent, desc_agent, task, rollout_ph, model, desc_to_code, session,
-        config, h0, z0, fold, mode):
-    demos = [task.get_demonstration(fold) for _ in range(config.trainer.n_rollout_episodes)]
-    worlds = [d[0].s1 for d in demos]
-    done = [False] * config.trainer.n_rollout_episodes
-    episodes = [[] for i in range(config.trainer.n_rollout_episodes)]
+        config, h0, z0, fold, mode, n_episodes, first_episode):
+    step = RolloutStep(rollout_ph, model, None, session, task, config)
+    randoms = _episode_randoms(first_episode, n_episodes)
+    demos = [task.get_demonstration(fold) for _ in range(n_episodes)]
+    starts = [d[0].s1 for d in demos]
+    if hasattr(task, "batch_from_states"):
+        worlds = task.batch_from_states(starts)
+    else:
+        worlds = StateBatch(starts)
+    done = np.zeros(n_episodes, dtype=bool)
+    total_rewards = np.zeros(n_episodes)
     hs, zs = h0, z0
     dhs = h0
 
     empty = np.zeros(len(task.lexicon))
     empty[0] = 1
-    last_desc = [empty] * config.trainer.n_rollout_episodes
+    last_desc = [empty] * n_episodes
 
     for t in range(config.trainer.n_timeout):
-        hs_, zs_, qs = session.run(
-                [model.tt_rollout_h, model.tt_rollout_z, model.tt_rollout_q],
-                rollout_ph.feed(hs, zs, dhs, worlds, task, config))
-        for i in range(config.trainer.n_rollout_episodes):
-            if done[i]:
-                continue
-
-            actions = [None, None]
-            actions[code_agent] = np.argmax(qs[code_agent][i, :])
-            if t < len(demos[i]):
-                actions[desc_agent] = demos[i][t].a[desc_agent]
-            else:
-                actions[desc_agent] = 0
+        hs_, zs_, qs = step(("h", "z", "q"), hs, zs, dhs, worlds, randoms)
+        actions = np.zeros((n_episodes, 2), dtype=np.int64)
+        actions[:, code_agent] = np.argmax(qs[code_agent], axis=1)
+        for i, demo in enumerate(demos):
+            if t < len(demo):
+                actions[i, desc_agent] = demo[t].a[desc_agent]
 
-            world_, reward, done_ = worlds[i].step(actions)
+        active = ~done
+        rewards, stops = worlds.step(actions, active)
+        total_rewards[active] += rewards[active]
 
+        for i in np.flatnonzero(active):
             if t < len(demos[i]):
                 desc = demos[i][t].s2.l_msg[code_agent]
                 last_desc[i] = desc
             else:
                 desc = last_desc[i]
-                #desc = np.zeros(len(task.lexicon))
-                #desc[0] = 1
 
-            #code = desc_to_code(desc, mode)[0]
             codes = desc_to_code(desc, mode)
-            #code = np.mean(codes, axis=0)
-            code = codes[random.randint(len(codes))]
-            #code = np.random.choice(desc_to_code(desc, mode))
-
-            #print(str(desc))
-            #print(str(code[:5]))
+            code = codes[randoms[i].randint(len(codes))]
             zs_[desc_agent][i, :] = code
 
-            episodes[i].append(Experience(
-                worlds[i], None, tuple(actions), world_, None, reward, done_))
-            worlds[i] = world_
-            done[i] = done_
-
+        done |= stops
         hs = hs_
         zs = zs_
-        if all(done):
+        if done.all():
             break
 
-    return (sum(e.r for ep in episodes for e in ep) * 1. / 
-                config.trainer.n_rollout_episodes, 
-            sum(ep[-1].s2.success for ep in episodes) * 1. /
-                config.trainer.n_rollout_episodes)
+    return total_rewards, [s.success for s in worlds.states()]
 
 def _do_tr_rollout(
         code_agent, desc_agent, task, rollout_ph, model, desc_model,
-        desc_to_code, code_to_desc, session, config, h0, z0, fold, mode):
-    worlds = [task.get_instance(fold) for _ in range(config.trainer.n_rollout_episodes)]
-    done = [False] * config.trainer.n_rollout_episodes
-    episodes = [[] for i in range(config.trainer.n_rollout_episodes)]
+        desc_to_code, code_to_desc, session, config, h0, z0, fold, mode,
+        n_episodes, first_episode):
+    step = RolloutStep(rollout_ph, model, desc_model, session, task, config)
+    randoms = _episode_randoms(first_episode, n_episodes)
+    worlds = task.get_batch(fold, n_episodes)
+    done = np.zeros(n_episodes, dtype=bool)
+    total_rewards = np.zeros(n_episodes)
     hs, zs = h0, z0
     dhs = h0
     for t in range(config.trainer.n_timeout):
-        hs_, zs_, qs = session.run(
-                [model.tt_rollout_h, model.tt_rollout_z, model.tt_rollout_q],
-                rollout_ph.feed(hs, zs, dhs, worlds, task, config))
-        dhs_, dqs = session.run(
-                [desc_model.tt_rollout_h, desc_model.tt_rollout_q],
-                rollout_ph.feed(hs, zs, dhs, worlds, task, config))
-        for i in range(config.trainer.n_rollout_episodes):
-            if done[i]:
-                continue
-
-            actions = [None, None]
-            actions[code_agent] = np.argmax(qs[code_agent][i, :])
-            actions[desc_agent] = np.argmax(dqs[desc_agent][i, :])
-
-            world_, reward, done_ = worlds[i].step(actions)
+        hs_, zs_, qs, dhs_, dqs = step(
+                ("h", "z", "q", "l_h", "l_q"), hs, zs, dhs, worlds, randoms)
+        actions = np.zeros((n_episodes, 2), dtype=np.int64)
+        actions[:, code_agent] = np.argmax(qs[code_agent], axis=1)
+        actions[:, desc_agent] = np.argmax(dqs[desc_agent], axis=1)
+
+        active = ~done
+        rewards, stops = worlds.step(actions, active)
+        total_rewards[active] += rewards[active]
+        states_ = worlds.states()
 
+        for i in np.flatnonzero(active):
+            world_ = states_[i]
             code = desc_to_code(world_.l_msg[code_agent], mode)[0]
             zs_[desc_agent][i, :] = code
 
@@ -111,90 +114,187 @@ def _do_tr_rollout(
             world_.l_msg[desc_agent] = l_msg
             world_.l_msg = tuple(world_.l_msg)
 
-            episodes[i].append(Experience(
-                worlds[i], None, tuple(actions), world_, None, reward, done_))
-            worlds[i] = world_
-            done[i] = done_
-
             if config.evaluator.simulate_l:
                 assert False
 
+        done |= stops
         hs = hs_
         zs = zs_
         dhs = dhs_
-        if all(done):
+        if done.all():
             break
 
-    return (sum(e.r for ep in episodes for e in ep) * 1. / 
-                config.trainer.n_rollout_episodes, 
-            sum(ep[-1].s2.success for ep in episodes) * 1. /
-                config.trainer.n_rollout_episodes)
+    return total_rewards, [s.success for s in worlds.states()]
+
+class RunningStats(object):
+    # mean and variance of per-episode scores, merged a batch at a time with
+    # the pairwise form of Welford's update
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        mean = np.mean(values, axis=0)
+        m2 = np.sum((values - mean) ** 2, axis=0)
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    # half-width of the 95% confidence interval on the mean
+    def ci(self):
+        if self.n < 2:
+            return np.inf * np.ones_like(self.mean)
+        return Z_95 * np.sqrt(self.m2 / (self.n - 1) / self.n)
+
+# runs up to n_total episodes through rollout(n_episodes, first_episode, h0,
+# z0), which returns per-episode rewards and successes, in batches of at most
+# n_batch. Stopping is only checked between batches: once the confidence
+# interval on the success rate is narrower than evaluator.ci_width (after at
+# least MIN_EPISODES), or after evaluator.time_budget seconds (either is off
+# when 0).
+def _run_batched(rollout, n_total, n_batch, h0, z0, config):
+    stats = RunningStats()
+    start_time = time.time()
+    for start in range(0, n_total, n_batch):
+        n = min(n_batch, n_total - start)
+        rewards, successes = rollout(
+                n, start, tuple(h[:n] for h in h0), tuple(z[:n] for z in z0))
+        stats.update(np.stack((rewards, successes), axis=1))
+        ci_width = config.evaluator.ci_width
+        time_budget = config.evaluator.time_budget
+        if (ci_width > 0 and stats.n >= MIN_EPISODES
+                and 2 * stats.ci()[1] <= ci_width):
+            break
+        if time_budget > 0 and time.time() - start_time >= time_budget:
+            break
+    return stats
+
+def _report(eval_f, tag, log_tag, stats):
+    if tag is None:
+        print >>eval_f, stats.mean
+    else:
+        print >>eval_f, tag, stats.mean
+    print >>eval_f, "  95% ci +/-", stats.ci(), "n", stats.n
+    logging.info("[%s]  \t%s\t+/- %s\tn %d" % (
+            log_tag, str(stats.mean), str(stats.ci()), stats.n))
+
+# task state that test rollouts advance: the test fold RNGs, RefTask's
+# left/right flips, and DriveTask's position in the test demonstrations
+TEST_STATE = ("random", "randoms", "test_counter")
+
+def _test_state(task):
+    return {
+            name: copy.deepcopy(getattr(task, name)) for name in TEST_STATE
+            if hasattr(task, name)}
+
+# a shallow copy of task started from state, with its test RNGs reset. Every
+# mode starts from the same state, so modes are independent of each other and
+# of the order they run in.
+def _mode_task(task, state):
+    mode_task = copy.copy(task)
+    for name, value in state.items():
+        setattr(mode_task, name, copy.deepcopy(value))
+    mode_task.reset_test()
+    return mode_task
 
 def run(task, rollout_ph, replay_ph, reconst_ph, model, desc_model,
         lexicographer, session, config, fold="test"):
-    h0, z0, _ = session.run(model.zero_state(1, tf.float32))
+    n_batch = config.evaluator.n_batch_episodes
+    h0, z0, _ = session.run(model.zero_state(n_batch, tf.float32))
 
     if isinstance(task, RefTask):
         count = config.evaluator.n_episodes
     else:
         #count = 100
         count = 500
+    n_total = count * config.trainer.n_rollout_episodes
+
+    def model_rollout(use_desc):
+        def rollout(n, start, h0, z0):
+            episodes = []
+            trainer._do_rollout(
+                    task, rollout_ph, model, desc_model, episodes, session,
+                    config, 10000, h0, z0, fold, use_desc=use_desc,
+                    n_episodes=n, randoms=_episode_randoms(start, n))
+            return ([sum(e.r for e in ep) for ep in episodes],
+                    [ep[-1].s2.success for ep in episodes])
+        return rollout
+
+    def tr_rollout(code_agent, desc_agent, mode, task):
+        return lambda n, start, h0, z0: _do_tr_rollout(
+                code_agent, desc_agent, task, rollout_ph, model, desc_model,
+                lexicographer.l_to_c, lexicographer.c_to_l, session, config,
+                h0, z0, fold, mode, n, start)
+
+    def deaf_rollout(code_agent, desc_agent, mode, task):
+        return lambda n, start, h0, z0: _do_deaf_rollout(
+                code_agent, desc_agent, task, rollout_ph, model,
+                lexicographer.l_to_c, session, config, h0, z0, fold, mode, n,
+                start)
+
+    # returns the (c, l) and (l, c) scores for mode, and the task whose RNGs
+    # have made the draws
+    def eval_mode(mode):
+        mode_task = _mode_task(task, mode_state)
+        if isinstance(task, RefTask):
+            rollout = tr_rollout(0, 1, mode, mode_task)
+        else:
+            rollout = deaf_rollout(0, 1, mode, mode_task)
+        c_l_score = _run_batched(rollout, n_total, n_batch, h0, z0, config)
+        l_c_score = None
+        if isinstance(task, RefTask):
+            mode_task.reset_test()
+            l_c_score = _run_batched(
+                    tr_rollout(1, 0, mode, mode_task), n_total, n_batch, h0,
+                    z0, config)
+        return c_l_score, l_c_score, mode_task
+
+    modes = ["fkl", "rkl", "pmi", "dot", "rand"]
+    n_threads = config.evaluator.n_threads
 
     with open(config.experiment_dir + "/eval.txt", "w") as eval_f:
         task.reset_test()
-        l_l_score = np.asarray([0., 0.])
-        for i in range(count):
-            score = trainer._do_rollout(
-                    task, rollout_ph, model, desc_model, [], [], session,
-                    config, 10000, h0, z0, fold, use_desc=True)
-            l_l_score += score
-        l_l_score /= count
-        logging.info("[l,l]  \t%s" % str(l_l_score))
+        l_l_score = _run_batched(
+                model_rollout(True), n_total, n_batch, h0, z0, config)
         print >>eval_f, "l only:"
-        print >>eval_f, l_l_score
+        _report(eval_f, None, "l,l", l_l_score)
 
         task.reset_test()
-        c_c_score = np.asarray([0., 0.])
-        for i in range(count):
-            score = trainer._do_rollout(
-                    task, rollout_ph, model, desc_model, [], [], session,
-                    config, 10000, h0, z0, fold, use_desc=False)
-            c_c_score += score
-        c_c_score /= count
-        logging.info("[c,c]  \t%s" % str(c_c_score))
-        logging.info("")
+        c_c_score = _run_batched(
+                model_rollout(False), n_total, n_batch, h0, z0, config)
         print >>eval_f, "c only:"
-        print >>eval_f, c_c_score
+        _report(eval_f, None, "c,c", c_c_score)
+        logging.info("")
+
+        # reset_test doesn't cover every stream (RefTask.random keeps going,
+        # as does DriveTask.test_counter), so each mode is explicitly started
+        # from the state left here rather than from where the previous mode
+        # stopped
+        mode_state = _test_state(task)
+        if n_threads > 1:
+            pool = ThreadPool(min(n_threads, len(modes)))
+            results = pool.map(eval_mode, modes)
+            pool.close()
+        else:
+            results = [eval_mode(mode) for mode in modes]
 
-        for mode in ["fkl", "rkl", "pmi", "dot", "rand"]:
+        for mode, (c_l_score, l_c_score, _) in zip(modes, results):
             print >>eval_f, mode + ":"
+            _report(eval_f, "(c, l)", "c,l:" + mode, c_l_score)
+            if l_c_score is not None:
+                _report(eval_f, "(l, c)", "l,c:" + mode, l_c_score)
+            logging.info("")
 
-            task.reset_test()
-            c_l_score = np.asarray([0., 0.])
-            for i in range(count):
-                if isinstance(task, RefTask):
-                    score = _do_tr_rollout(
-                            0, 1, task, rollout_ph, model, desc_model, lexicographer.l_to_c,
-                            lexicographer.c_to_l, session, config, h0, z0, fold, mode)
-                else:
-                    score = _do_deaf_rollout(
-                            0, 1, task, rollout_ph, model, lexicographer.l_to_c, 
-                            session, config, h0, z0, fold, mode)
-                c_l_score += score
-            c_l_score /= count
-            print >>eval_f, "(c, l)", c_l_score
-            logging.info("[c,l:%s]  \t%s" % (mode, str(c_l_score)))
-
-            if isinstance(task, RefTask):
-                task.reset_test()
-                l_c_score = np.asarray([0., 0.])
-                for i in range(count):
-                    score = _do_tr_rollout(
-                            1, 0, task, rollout_ph, model, desc_model, lexicographer.l_to_c,
-                            lexicographer.c_to_l, session, config, h0, z0, fold, mode)
-                    l_c_score += score
-                l_c_score /= count
-                print >>eval_f, "(l, c)", l_c_score
-                logging.info("[l,c:%s]  \t%s" % (mode, str(l_c_score)))
+        logging.info("[cache]\thits %d\tmisses %d" % (
+                lexicographer.cache_hits, lexicographer.cache_misses))
+        logging.info("")
 
-            logging.info("")
+    # leave the task where the last mode stopped, as a sequential run would
+    _, _, last_task = results[-1]
+    for name, value in _test_state(last_task).items():
+        setattr(task, name, value)
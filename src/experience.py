@@ -1,67 +1,226 @@
+import net
+
 from collections import namedtuple
 import numpy as np
 import tensorflow as tf
 
 Experience = namedtuple("Experience", ["s1", "m1", "a", "s2", "m2", "r", "t"])
 
+class Episode(object):
+    # per-step arrays are laid out as (time, agent, ...) so that replay feeds
+    # can be built by concatenating episodes and gathering rows
+    FIELDS = (
+        "experiences", "x", "x_next", "x_index", "x_value", "x_next_index",
+        "x_next_value", "action", "reward", "terminal", "l_msg", "l_msg_next",
+        "h", "z", "l_h", "h_next", "z_next", "l_h_next")
+
+    def __init__(self, experiences):
+        self.experiences = experiences
+        self.x = np.asarray(
+                [e.s1.obs() for e in experiences], dtype=np.float32)
+        self.x_next = np.asarray(
+                [e.s2.obs() for e in experiences], dtype=np.float32)
+        if hasattr(experiences[0].s1, "obs_indices"):
+            self.x_index, self.x_value = _stack_indices(
+                    [e.s1.obs_indices() for e in experiences])
+            self.x_next_index, self.x_next_value = _stack_indices(
+                    [e.s2.obs_indices() for e in experiences])
+        else:
+            self.x_index = self.x_value = None
+            self.x_next_index = self.x_next_value = None
+        self.action = np.asarray([e.a for e in experiences], dtype=np.int32)
+        self.reward = np.asarray([e.r for e in experiences], dtype=np.float32)
+        self.terminal = np.asarray(
+                [e.t for e in experiences], dtype=np.float32)
+        self.l_msg = np.asarray(
+                [e.s1.l_msg for e in experiences], dtype=np.float32)
+        self.l_msg_next = np.asarray(
+                [e.s2.l_msg for e in experiences], dtype=np.float32)
+
+        if experiences[0].m1 is not None:
+            self.h, self.z, self.l_h = (
+                    np.asarray([e.m1[i] for e in experiences], dtype=np.float32)
+                    for i in range(3))
+            self.h_next, self.z_next, self.l_h_next = (
+                    np.asarray([e.m2[i] for e in experiences], dtype=np.float32)
+                    for i in range(3))
+        else:
+            self.h = self.z = self.l_h = None
+            self.h_next = self.z_next = self.l_h_next = None
+
+    def __len__(self):
+        return len(self.experiences)
+
+    def __iter__(self):
+        return iter(self.experiences)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self.experiences[key]
+        sliced = Episode.__new__(Episode)
+        for field in Episode.FIELDS:
+            value = getattr(self, field)
+            setattr(sliced, field, None if value is None else value[key])
+        return sliced
+
+def _stack_indices(indices):
+    return (
+            np.asarray([i for i, _ in indices], dtype=np.int32),
+            np.asarray([v for _, v in indices], dtype=np.float32))
+
+class StateBatch(object):
+    # list-backed batch for tasks without a vectorized simulator; exposes the
+    # same interface as tasks.drive.DriveBatch
+    def __init__(self, states):
+        self._states = list(states)
+
+    def __len__(self):
+        return len(self._states)
+
+    def get_step_state(self):
+        return self._states
+
+    def set_step_state(self, step_state):
+        self._states = list(step_state)
+
+    @property
+    def l_msg(self):
+        return tuple(
+                np.asarray([s.l_msg[i_agent] for s in self._states])
+                for i_agent in range(len(self._states[0].l_msg)))
+
+    def states(self):
+        return list(self._states)
+
+    def obs(self):
+        obs = [s.obs() for s in self._states]
+        return tuple(
+                np.asarray([o[i_agent] for o in obs])
+                for i_agent in range(len(obs[0])))
+
+    def obs_indices(self):
+        return _stack_indices([s.obs_indices() for s in self._states])
+
+    def step(self, actions, active=None):
+        reward = np.zeros(len(self._states))
+        stop = np.zeros(len(self._states), dtype=bool)
+        for i, state in enumerate(self._states):
+            if active is not None and not active[i]:
+                continue
+            self._states[i], reward[i], stop[i] = state.step(tuple(actions[i]))
+        return reward, stop
+
+# in sparse mode each agent's observation is fed as (index, value) pairs; the
+# dense view is rebuilt in the graph for the models that still want it
+def _sparse_obs_placeholders(shape, task):
+    t_index = tf.placeholder(tf.int32, shape + (task.n_obs_indices,))
+    t_value = tf.placeholder(tf.float32, shape + (task.n_obs_indices,))
+    return t_index, t_value, net.densify(t_index, t_value, task.n_features)
+
 class RolloutPlaceholders(object):
+    # the batch dimension is left open so that evaluation can roll out many
+    # episodes at once
     def __init__(self, task, config):
         t_x = []
+        t_x_sparse = []
         t_h = []
         t_z = []
         t_fake_q = []
         t_fake_l_msg = []
         t_l_msg = []
         t_l_h = []
+        t_noise = []
         for i_agent in range(task.n_agents):
-            t_x.append(tf.placeholder(
-                    tf.float32, (config.trainer.n_rollout_episodes,
-                        task.n_features)))
+            if config.model.sparse_obs:
+                t_index, t_value, t_dense = _sparse_obs_placeholders(
+                        (None,), task)
+                t_x_sparse.append((t_index, t_value))
+                t_x.append(t_dense)
+            else:
+                t_x.append(tf.placeholder(
+                        tf.float32, (None, task.n_features)))
             t_h.append(tf.placeholder(
-                    tf.float32, (config.trainer.n_rollout_episodes,
-                        config.model.n_hidden)))
+                    tf.float32, (None, config.model.n_hidden)))
             t_z.append(tf.placeholder(
-                    tf.float32, (config.trainer.n_rollout_episodes,
-                        config.channel.n_msg)))
+                    tf.float32, (None, config.channel.n_msg)))
+            t_n_batch = tf.shape(t_h[-1])[0]
             t_fake_q.append(tf.zeros(
-                    (config.trainer.n_rollout_episodes, task.n_actions[i_agent]),
+                    tf.pack((t_n_batch, task.n_actions[i_agent])),
                     tf.float32))
             t_fake_l_msg.append(tf.zeros(
-                    (config.trainer.n_rollout_episodes, len(task.lexicon))))
+                    tf.pack((t_n_batch, len(task.lexicon)))))
             t_l_msg.append(tf.placeholder(
-                    tf.float32, (config.trainer.n_rollout_episodes,
-                        len(task.lexicon))))
+                    tf.float32, (None, len(task.lexicon))))
             t_l_h.append(tf.placeholder(
-                    tf.float32, (config.trainer.n_rollout_episodes,
-                        config.model.n_hidden)))
+                    tf.float32, (None, config.model.n_hidden)))
+            # standard normal noise for the message this agent sends; the
+            # graph draws it unless it is fed
+            t_noise.append(tf.placeholder_with_default(
+                    tf.random_normal(tf.shape(t_z[-1])),
+                    (None, config.channel.n_msg)))
         self.t_x = tuple(t_x)
+        self.t_x_sparse = tuple(t_x_sparse) if t_x_sparse else None
         self.t_h = tuple(t_h)
         self.t_z = tuple(t_z)
         self.t_fake_q = tuple(t_fake_q)
         self.t_fake_l_msg = tuple(t_fake_l_msg)
         self.t_l_msg = tuple(t_l_msg)
         self.t_l_h = tuple(t_l_h)
+        self.t_noise = tuple(t_noise)
 
     def feed(self, hs, zs, l_hs, worlds, task, config):
+        if isinstance(worlds, list):
+            worlds = StateBatch(worlds)
         out = {}
-        obs = [w.obs() for w in worlds]
-        l_msg = [np.zeros((config.trainer.n_rollout_episodes, len(task.lexicon)))
-                for _ in range(task.n_agents)]
-        for i, w in enumerate(worlds):
-            for i_agent in range(task.n_agents):
-                l_msg[i_agent][i, :] = w.l_msg[i_agent]
-        for i_t, t in enumerate(self.t_x):
-            out[t] = [
-                    obs[i][i_t] for i in range(config.trainer.n_rollout_episodes)]
+        if self.t_x_sparse is not None:
+            index, value = worlds.obs_indices()
+            for i_agent, (t_index, t_value) in enumerate(self.t_x_sparse):
+                out[t_index] = index[:, i_agent]
+                out[t_value] = value[:, i_agent]
+        else:
+            obs = worlds.obs()
+            for i_agent, t in enumerate(self.t_x):
+                out[t] = obs[i_agent]
+        l_msg = worlds.l_msg
         for i_agent, t in enumerate(self.t_l_msg):
-            out[t] = [
-                    l_msg[i_agent][i, :] 
-                    for i in range(config.trainer.n_rollout_episodes)]
+            out[t] = l_msg[i_agent]
         out[self.t_h] = hs
         out[self.t_z] = zs
         out[self.t_l_h] = l_hs
         return out
 
+class RolloutStep(object):
+    # One rollout step of model and desc_model on a single feed, fetching
+    # only the named outputs: "h", "z" and "q" from model, "l_h" and "l_q"
+    # from desc_model. Given one RandomState per episode, channel noise is
+    # drawn from those rather than by the graph, so that an episode's noise
+    # doesn't depend on which batch it runs in.
+    def __init__(self, rollout_ph, model, desc_model, session, task, config):
+        self.rollout_ph = rollout_ph
+        self.session = session
+        self.task = task
+        self.config = config
+        self.fetches = {}
+        if model is not None:
+            self.fetches.update(
+                    h=model.tt_rollout_h, z=model.tt_rollout_z,
+                    q=model.tt_rollout_q)
+        if desc_model is not None:
+            self.fetches.update(
+                    l_h=desc_model.tt_rollout_h, l_q=desc_model.tt_rollout_q)
+
+    def __call__(self, outputs, hs, zs, l_hs, worlds, randoms=None):
+        feed = self.rollout_ph.feed(
+                hs, zs, l_hs, worlds, self.task, self.config)
+        if randoms is not None:
+            noise = np.asarray([
+                    random.randn(self.task.n_agents, self.config.channel.n_msg)
+                    for random in randoms])
+            for i_agent, t_noise in enumerate(self.rollout_ph.t_noise):
+                feed[t_noise] = noise[:, i_agent]
+        return self.session.run(
+                [self.fetches[name] for name in outputs], feed)
+
 class ReconstructionPlaceholders(object):
     def __init__(self, task, config):
         self.t_xb = tf.placeholder(
@@ -79,6 +238,11 @@ class ReconstructionPlaceholders(object):
                     task.n_features))
         self.t_l_msg = tf.placeholder(tf.float32,
                 (config.trainer.n_batch_episodes, len(task.lexicon)))
+        # any number of messages, each scored against the whole batch
+        self.t_z_batch = tf.placeholder(
+                tf.float32, (None, config.channel.n_msg))
+        self.t_l_msg_batch = tf.placeholder(
+                tf.float32, (None, len(task.lexicon)))
 
     def feed(self, experiences, obs_agent, hidden_agent, task, config):
         xb = np.zeros((config.trainer.n_batch_episodes, task.n_features))
@@ -91,20 +255,17 @@ class ReconstructionPlaceholders(object):
                 (config.trainer.n_batch_episodes, config.trainer.n_distractors,
                     task.n_features))
 
-        for i, experience in enumerate(experiences):
-            state1 = experience.s1
-            state2 = experience.s2
-            xb[i, :] = state2.obs()[obs_agent]
-            if experience.m2 is not None:
-                message = experience.m2[1][hidden_agent]
-                z[i, :] = message
-            l_msg[i, :] = state2.l_msg[obs_agent]
-            xa_true[i, :] = state1.obs()[hidden_agent]
-            distractors = task.distractors_for(
-                    state1, obs_agent, config.trainer.n_distractors)
-            for i_dis in range(config.trainer.n_distractors):
-                dis, prob = distractors[i_dis]
-                xa_noise[i, i_dis, :] = dis.obs()[hidden_agent]
+        n = len(experiences)
+        states1 = [e.s1 for e in experiences]
+        states2 = [e.s2 for e in experiences]
+        xb[:n] = [s.obs()[obs_agent] for s in states2]
+        if experiences[0].m2 is not None:
+            z[:n] = [e.m2[1][hidden_agent] for e in experiences]
+        l_msg[:n] = [s.l_msg[obs_agent] for s in states2]
+        xa_true[:n] = [s.obs()[hidden_agent] for s in states1]
+        xa_noise[:n] = task.distractor_obs(
+                states1, obs_agent, config.trainer.n_distractors)[
+                    :, :, hidden_agent, :]
 
         return {
             self.t_xb: xb,
@@ -128,9 +289,15 @@ class ReplayPlaceholders(object):
                 tf.float32,
                 (config.trainer.n_batch_episodes,
                     config.trainer.n_batch_history))
+        # importance-sampling weights, only fed by prioritized replay
+        self.t_weight = tf.placeholder_with_default(
+                tf.ones((config.trainer.n_batch_episodes,)),
+                (config.trainer.n_batch_episodes,))
 
         t_x = []
         t_x_next = []
+        t_x_sparse = []
+        t_x_next_sparse = []
         t_z = []
         t_z_next = []
         t_h = []
@@ -146,16 +313,28 @@ class ReplayPlaceholders(object):
         t_action = []
         t_action_index = []
         for i_agent in range(task.n_agents):
-            t_x.append(tf.placeholder(
-                    tf.float32,
-                    (config.trainer.n_batch_episodes,
-                        config.trainer.n_batch_history,
-                        task.n_features)))
-            t_x_next.append(tf.placeholder(
-                    tf.float32,
-                    (config.trainer.n_batch_episodes,
-                        config.trainer.n_batch_history,
-                        task.n_features)))
+            if config.model.sparse_obs:
+                shape = (config.trainer.n_batch_episodes,
+                        config.trainer.n_batch_history)
+                t_index, t_value, t_dense = _sparse_obs_placeholders(
+                        shape, task)
+                t_x_sparse.append((t_index, t_value))
+                t_x.append(t_dense)
+                t_index, t_value, t_dense = _sparse_obs_placeholders(
+                        shape, task)
+                t_x_next_sparse.append((t_index, t_value))
+                t_x_next.append(t_dense)
+            else:
+                t_x.append(tf.placeholder(
+                        tf.float32,
+                        (config.trainer.n_batch_episodes,
+                            config.trainer.n_batch_history,
+                            task.n_features)))
+                t_x_next.append(tf.placeholder(
+                        tf.float32,
+                        (config.trainer.n_batch_episodes,
+                            config.trainer.n_batch_history,
+                            task.n_features)))
 
             t_l_msg.append(tf.placeholder(
                     tf.float32,
@@ -212,6 +391,11 @@ class ReplayPlaceholders(object):
                         config.trainer.n_batch_history)))
         self.t_x = tuple(t_x)
         self.t_x_next = tuple(t_x_next)
+        self.t_x_sparse = tuple(t_x_sparse) if t_x_sparse else None
+        self.t_x_next_sparse = (
+                tuple(t_x_next_sparse) if t_x_next_sparse else None)
+        self.t_x_sparse_flat = sum(t_x_sparse, ())
+        self.t_x_next_sparse_flat = sum(t_x_next_sparse, ())
         self.t_z = tuple(t_z)
         self.t_z_next = tuple(t_z_next)
         self.t_h = tuple(t_h)
@@ -231,9 +415,46 @@ class ReplayPlaceholders(object):
         n_batch = len(episodes)
         n_history = config.trainer.n_batch_history
 
-        reward = np.zeros((n_batch, n_history))
-        terminal = np.zeros((n_batch, n_history))
-        mask = np.zeros((n_batch, n_history))
+        lengths = np.asarray([len(ep) for ep in episodes])
+        offsets = np.cumsum(lengths) - lengths
+        mask = np.arange(n_history)[np.newaxis, :] < lengths[:, np.newaxis]
+        index = np.where(
+                mask, offsets[:, np.newaxis] + np.arange(n_history), 0)
+        empty = ~mask
+
+        def gather(field):
+            data = np.concatenate([getattr(ep, field) for ep in episodes])
+            out = data[index]
+            out[empty] = 0
+            return out
+
+        reward = gather("reward")
+        terminal = gather("terminal")
+        sparse = self.t_x_sparse is not None
+        if sparse:
+            all_x_index = gather("x_index")
+            all_x_value = gather("x_value")
+            all_x_next_index = gather("x_next_index")
+            all_x_next_value = gather("x_next_value")
+        else:
+            all_x = gather("x")
+            all_x_next = gather("x_next")
+        all_action_index = gather("action")
+        all_l_msg = gather("l_msg")
+        all_l_msg_next = gather("l_msg_next")
+
+        if episodes[0].h is not None:
+            memories = []
+            for field in ("h", "z", "l_h", "h_next", "z_next", "l_h_next"):
+                data = np.concatenate([getattr(ep, field) for ep in episodes])
+                memories.append(data[offsets])
+        else:
+            memories = [
+                    np.zeros((n_batch, task.n_agents, config.model.n_hidden)),
+                    np.zeros((n_batch, task.n_agents, config.channel.n_msg)),
+                    np.zeros((n_batch, task.n_agents, config.model.n_hidden))
+                ] * 2
+        all_h, all_z, all_l_h, all_h_next, all_z_next, all_l_h_next = memories
 
         x = []
         x_next = []
@@ -249,43 +470,27 @@ class ReplayPlaceholders(object):
         l_msg_next = []
         l_msg_target = [None, None]
         for i_agent in range(task.n_agents):
-            x.append(np.zeros((n_batch, n_history, task.n_features)))
-            x_next.append(np.zeros((n_batch, n_history, task.n_features)))
-            h.append(np.zeros((n_batch, config.model.n_hidden)))
-            h_next.append(np.zeros((n_batch, config.model.n_hidden)))
-            z.append(np.zeros((n_batch, config.channel.n_msg)))
-            z_next.append(np.zeros((n_batch, config.channel.n_msg)))
-            l_h.append(np.zeros((n_batch, config.model.n_hidden)))
-            l_h_next.append(np.zeros((n_batch, config.model.n_hidden)))
-            action.append(
-                    np.zeros((n_batch, n_history, task.n_actions[i_agent])))
-            action_index.append(np.zeros((n_batch, n_history)))
-            l_msg.append(np.zeros((n_batch, n_history, len(task.lexicon))))
-            l_msg_next.append(np.zeros((n_batch, n_history, len(task.lexicon))))
-
-        for i in range(n_batch):
-            ep = episodes[i]
-            for i_agent in range(task.n_agents):
-                if ep[0].m1 is not None:
-                    h[i_agent][i, :] = ep[0].m1[0][i_agent]
-                    z[i_agent][i, :] = ep[0].m1[1][i_agent]
-                    l_h[i_agent][i, :] = ep[0].m1[2][i_agent]
-                    h_next[i_agent][i, :] = ep[0].m2[0][i_agent]
-                    z_next[i_agent][i, :] = ep[0].m2[1][i_agent]
-                    l_h_next[i_agent][i, :] = ep[0].m2[2][i_agent]
-            for j in range(len(ep)):
-                reward[i, j] = ep[j].r
-                terminal[i, j] = ep[j].t
-                mask[i, j] = 1
-                for i_agent in range(task.n_agents):
-                    x[i_agent][i, j, :] = ep[j].s1.obs()[i_agent]
-                    x_next[i_agent][i, j, :] = ep[j].s2.obs()[i_agent]
-                    action[i_agent][i, j, ep[j].a[i_agent]] = 1
-                    action_index[i_agent][i, j] = ep[j].a[i_agent]
-                    l1 = ep[j].s1.l_msg
-                    l2 = ep[j].s2.l_msg
-                    l_msg[i_agent][i, j, :] = l1[i_agent]
-                    l_msg_next[i_agent][i, j, :] = l2[i_agent]
+            if sparse:
+                x += [all_x_index[:, :, i_agent, :],
+                        all_x_value[:, :, i_agent, :]]
+                x_next += [all_x_next_index[:, :, i_agent, :],
+                        all_x_next_value[:, :, i_agent, :]]
+            else:
+                x.append(all_x[:, :, i_agent, :])
+                x_next.append(all_x_next[:, :, i_agent, :])
+            h.append(all_h[:, i_agent, :])
+            h_next.append(all_h_next[:, i_agent, :])
+            z.append(all_z[:, i_agent, :])
+            z_next.append(all_z_next[:, i_agent, :])
+            l_h.append(all_l_h[:, i_agent, :])
+            l_h_next.append(all_l_h_next[:, i_agent, :])
+            agent_action = all_action_index[:, :, i_agent]
+            one_hot = np.eye(task.n_actions[i_agent])[agent_action]
+            one_hot[empty] = 0
+            action.append(one_hot)
+            action_index.append(agent_action)
+            l_msg.append(all_l_msg[:, :, i_agent, :])
+            l_msg_next.append(all_l_msg_next[:, :, i_agent, :])
         assert task.n_agents == 2
         l_msg_target[0] = l_msg_next[1]
         l_msg_target[1] = l_msg_next[0]
@@ -293,9 +498,9 @@ class ReplayPlaceholders(object):
         return {
             self.t_reward: reward,
             self.t_terminal: terminal,
-            self.t_mask: mask,
-            self.t_x: x,
-            self.t_x_next: x_next,
+            self.t_mask: mask.astype(np.float32),
+            self.t_x_sparse_flat if sparse else self.t_x: x,
+            self.t_x_next_sparse_flat if sparse else self.t_x_next: x_next,
             self.t_h: h,
             self.t_h_next: h_next,
             self.t_z: z,
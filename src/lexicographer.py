@@ -1,42 +1,86 @@
 from experience import Experience
+import nn_index
+from nn_index import top_k
 import trainer
 from util import Break
 
+from collections import OrderedDict
+import cPickle as pickle
 import json
+import logging
 import numpy as np
+import os
 from scipy.misc import logsumexp
+import shutil
 import tensorflow as tf
+import threading
 
-def kl(d1, d2, w1, w2):
-    assert len(d1.shape) == len(d2.shape) == 2
-    assert len(w1.shape) == len(w2.shape) == 1
+N_CANDIDATES = 10
+# messages per batched belief run; bounds the (messages, batch, choices,
+# n_msg) intermediate in the model belief graph
+BELIEF_BATCH = 256
 
-    raw_weights = logsumexp([w1, w2], axis=0)
-    denom = logsumexp(raw_weights)
-    weights = np.exp(raw_weights - denom)
+TRANSLATION_CACHE_SIZE = 10000
+# queries ranked together; bounds the (queries, candidates, batch, choices)
+# intermediates of the comparators
+QUERY_BATCH = 16
 
-    return np.sum(weights[:, np.newaxis] * d1 * (np.log(d1) - np.log(d2)))
+# saved next to the checkpoint so that later stages and runs can reuse the
+# lexicon instead of rebuilding it
+ARTIFACT_ARRAYS = (
+        "codes", "xb", "xa_true", "xa_noise", "l_beliefs", "l_weights",
+        "model_beliefs", "model_weights")
 
-def fkl(d1, d2, w1, w2):
-    return kl(d1, d2, w1, w2)
+class Beliefs(object):
+    # beliefs (N, batch, choices) and log-weights (N, batch) for N messages;
+    # the logs are computed once and shared by every comparator
+    def __init__(self, beliefs, weights):
+        self.beliefs = np.asarray(beliefs)
+        self.weights = np.asarray(weights)
+        self.log_beliefs = np.log(self.beliefs)
+        self.log_norm = logsumexp(self.weights, axis=-1)
 
-def rkl(d1, d2, w1, w2):
-    return kl(d2, d1, w2, w1)
+    def __len__(self):
+        return len(self.beliefs)
 
-def skl(d1, d2, w1, w2):
-    return kl(d1, d2, w1, w2) + kl(d2, d1, w2, w1)
+    # indexes the message axes only, e.g. queries[:, np.newaxis]
+    def __getitem__(self, key):
+        out = Beliefs.__new__(Beliefs)
+        for name in ("beliefs", "weights", "log_beliefs", "log_norm"):
+            setattr(out, name, getattr(self, name)[key])
+        return out
 
-def dot(d1, d2, w1, w2):
-    #return -np.dot(w1, w2)
-    return -logsumexp(w1 + w2)
+# Comparators score pairs of messages by broadcasting over the leading
+# (message) axes: a (Q, 1) set of queries against N candidates gives a (Q, N)
+# array of scores; lower is better.
 
-def pmi(d1, d2, w1, w2):
-    #return -np.dot(w1, w2) / (np.sum(w1) * np.sum(w2))
-    return -logsumexp(w1 + w2) + logsumexp(w1) + logsumexp(w2)
+def kl(d1, d2):
+    raw_weights = np.logaddexp(d1.weights, d2.weights)
+    denom = logsumexp(raw_weights, axis=-1)
+    weights = np.exp(raw_weights - denom[..., np.newaxis])
+    return np.sum(
+            weights[..., np.newaxis] * d1.beliefs
+                * (d1.log_beliefs - d2.log_beliefs),
+            axis=(-2, -1))
+
+def fkl(d1, d2):
+    return kl(d1, d2)
+
+def rkl(d1, d2):
+    return kl(d2, d1)
+
+def skl(d1, d2):
+    return kl(d1, d2) + kl(d2, d1)
+
+def dot(d1, d2):
+    return -logsumexp(d1.weights + d2.weights, axis=-1)
+
+def pmi(d1, d2):
+    return dot(d1, d2) + d1.log_norm + d2.log_norm
 
 random = np.random.RandomState(7846)
-def rand(d1, d2, w1, w2):
-    return random.rand()
+def rand(d1, d2):
+    return random.rand(*np.broadcast(d1.log_norm, d2.log_norm).shape)
 
 def get_comparator(mode):
     if mode == "skl":
@@ -55,11 +99,22 @@ def get_comparator(mode):
         assert False
     return comparator
 
+# dot and pmi are both -logsumexp(q + v) for per-message log-vectors q and
+# v, so they can be answered by an nn_index instead of a full scan
+INDEXED_MODES = ("dot", "pmi")
+
+def log_vectors(beliefs, mode):
+    if mode == "dot":
+        return beliefs.weights
+    elif mode == "pmi":
+        return beliefs.weights - beliefs.log_norm[:, np.newaxis]
+    else:
+        assert False
+
 class Lexicographer(object):
     def __init__(self, states, codes, l_msgs, ph, translator, task, session,
-            config):
+            config, saved=None):
         self.states = states
-        self.distractors = []
         self.codes = codes
         self.l_msgs = l_msgs
         self.translator = translator
@@ -67,7 +122,27 @@ class Lexicographer(object):
         self.config = config
         self.session = session
         self.ph = ph
+        # query beliefs and translations keyed by message contents; "rand"
+        # translations are never cached since they should differ per call.
+        # The evaluator may translate from several threads at once, so the
+        # cache and indices are only touched under the lock.
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.indices = {}
+
+        if saved is None:
+            self._compute(states, codes, l_msgs, task, config)
+        else:
+            self.distractors = saved["distractors"]
+            for name in ARTIFACT_ARRAYS:
+                setattr(self, name, saved[name])
+        self.l_set = Beliefs(self.l_beliefs, self.l_weights)
+        self.model_set = Beliefs(self.model_beliefs, self.model_weights)
 
+    def _compute(self, states, codes, l_msgs, task, config):
+        self.distractors = []
         xb = np.zeros((config.trainer.n_batch_episodes, task.n_features))
         xa_true = np.zeros((config.trainer.n_batch_episodes, task.n_features))
         xa_noise = np.zeros(
@@ -86,23 +161,60 @@ class Lexicographer(object):
         self.xa_true = xa_true
         self.xa_noise = xa_noise
 
-        all_l_beliefs = []
-        all_l_weights = []
-        for l_msg in l_msgs:
-            l_beliefs, l_weights = self.compute_l_belief(l_msg)
-            all_l_beliefs.append(l_beliefs)
-            all_l_weights.append(l_weights)
-        self.l_beliefs = all_l_beliefs
-        self.l_weights = all_l_weights
-
-        all_model_beliefs = []
-        all_model_weights = []
-        for code in codes:
-            model_beliefs, model_weights = self.compute_code_belief(code)
-            all_model_beliefs.append(model_beliefs)
-            all_model_weights.append(model_weights)
-        self.model_beliefs = all_model_beliefs
-        self.model_weights = all_model_weights
+        l_data = np.zeros((len(l_msgs), len(task.lexicon)))
+        l_data[np.arange(len(l_msgs)),
+                [task.lexicon.index(l_msg) for l_msg in l_msgs]] = 1
+        self.l_beliefs, self.l_weights = self.compute_l_beliefs(l_data)
+        self.model_beliefs, self.model_weights = \
+                self.compute_code_beliefs(codes)
+
+    def save(self, directory, key):
+        tmp_directory = directory + ".tmp"
+        if os.path.exists(tmp_directory):
+            shutil.rmtree(tmp_directory)
+        os.mkdir(tmp_directory)
+        for name in ARTIFACT_ARRAYS:
+            np.save(os.path.join(tmp_directory, name + ".npy"),
+                    np.asarray(getattr(self, name)))
+        state = {
+            "key": key,
+            "states": self.states,
+            "distractors": self.distractors,
+            "l_msgs": self.l_msgs
+        }
+        with open(os.path.join(tmp_directory, "state.pkl"), "wb") as state_f:
+            pickle.dump(state, state_f, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp_directory, directory)
+
+    def _run_batched(self, t_in, data, outputs):
+        beliefs = []
+        weights = []
+        for start in range(0, len(data), BELIEF_BATCH):
+            feed = {
+                self.ph.t_xa_true: self.xa_true,
+                self.ph.t_xa_noise: self.xa_noise,
+                t_in: data[start:start+BELIEF_BATCH]
+            }
+            b, w = self.session.run(outputs, feed)
+            beliefs.append(b)
+            weights.append(w)
+        return np.concatenate(beliefs), np.concatenate(weights)
+
+    # beliefs and log-weights for many descriptions (rows of l_data) or codes
+    # in as few session runs as possible
+    def compute_l_beliefs(self, l_data):
+        return self._run_batched(
+                self.ph.t_l_msg_batch, np.asarray(l_data),
+                [self.translator.t_desc_belief_batch,
+                    self.translator.t_desc_logweights_batch])
+
+    def compute_code_beliefs(self, codes):
+        return self._run_batched(
+                self.ph.t_z_batch, np.asarray(codes),
+                [self.translator.t_model_belief_batch,
+                    self.translator.t_model_logweights_batch])
 
     def compute_l_belief(self, l_msg, raw_features=None):
         l_data = np.zeros(
@@ -135,39 +247,191 @@ class Lexicographer(object):
                 feed)
         return model_beliefs, model_weights
 
+    def _lookup(self, key):
+        with self.lock:
+            if key not in self.cache:
+                return None
+            # refresh the entry so that eviction is least-recently-used
+            value = self.cache.pop(key)
+            self.cache[key] = value
+            self.cache_hits += 1
+            return value
+
+    def _cached(self, key, compute):
+        value = self._lookup(key)
+        if value is not None:
+            return value
+        with self.lock:
+            self.cache_misses += 1
+        value = compute()
+        self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        with self.lock:
+            if len(self.cache) >= TRANSLATION_CACHE_SIZE:
+                self.cache.popitem(last=False)
+            self.cache[key] = value
+
+    # the best candidate indices for each of a set of queries
+    def _rank(self, kind, mode, queries, candidates):
+        if mode in INDEXED_MODES:
+            index = self._index(kind, mode, candidates)
+            return [
+                    index.search(query, N_CANDIDATES)
+                    for query in log_vectors(queries, mode)]
+        comparator = get_comparator(mode)
+        best = []
+        for start in range(0, len(queries), QUERY_BATCH):
+            scores = comparator(
+                    queries[start:start+QUERY_BATCH, np.newaxis], candidates)
+            best += [top_k(row, N_CANDIDATES) for row in scores]
+        return best
+
+    def _index(self, kind, mode, candidates):
+        with self.lock:
+            if (kind, mode) not in self.indices:
+                index = nn_index.load(self.config)
+                index.build(log_vectors(candidates, mode))
+                self.indices[kind, mode] = index
+            return self.indices[kind, mode]
+
+    def _translate(self, kind, msg, mode, compute_belief, candidates, out):
+        msg_key = np.asarray(msg, dtype=np.float64).tobytes()
+
+        def belief():
+            return Beliefs(*[[x] for x in compute_belief()])
+
+        def translate():
+            query = self._cached((kind, msg_key), belief)
+            best, = self._rank(kind, mode, query, candidates)
+            return [out[c] for c in best]
+
+        if mode == "rand":
+            return translate()
+        return list(self._cached((kind, mode, msg_key), translate))
+
+    # like _translate for a list of messages, with all the uncached beliefs
+    # computed in one batched run
+    def _translate_batch(
+            self, kind, msgs, mode, compute_beliefs, candidates, out):
+        results = [None] * len(msgs)
+        keys = []
+        groups = OrderedDict()
+        for i, msg in enumerate(msgs):
+            msg_key = np.asarray(msg, dtype=np.float64).tobytes()
+            keys.append(msg_key)
+            cached = None
+            if mode != "rand":
+                cached = self._lookup((kind, mode, msg_key))
+            if cached is not None:
+                results[i] = list(cached)
+            else:
+                # repeated messages share a translation, except under "rand"
+                group = i if mode == "rand" else msg_key
+                groups.setdefault(group, []).append(i)
+        if len(groups) == 0:
+            return results
+        with self.lock:
+            self.cache_misses += len(groups)
+
+        queries = Beliefs(*compute_beliefs(
+                np.asarray([msgs[indices[0]] for indices in groups.values()])))
+        for indices, best in zip(
+                groups.values(),
+                self._rank(kind, mode, queries, candidates)):
+            translation = [out[c] for c in best]
+            if mode != "rand":
+                self._store((kind, mode, keys[indices[0]]), translation)
+            for i in indices:
+                results[i] = list(translation)
+        return results
+
     def l_to_c(self, l_msg, mode):
         if not l_msg.any():
             assert False
             return [np.zeros(self.config.channel.n_msg)]
-        l_belief, l_weights = self.compute_l_belief(None, raw_features=l_msg)
-        comparator = get_comparator(mode)
-        candidates = sorted(
-                range(len(self.codes)),
-                key=lambda i: comparator(
-                    l_belief, self.model_beliefs[i],
-                    l_weights, self.model_weights[i]
-                ))
-        return [self.codes[c] for c in candidates[:10]]
+        return self._translate(
+                "l", l_msg, mode,
+                lambda: self.compute_l_belief(None, raw_features=l_msg),
+                self.model_set, self.codes)
 
     def c_to_l(self, code, mode):
         if not code.any():
             return [[0]]
-        code_belief, code_weights = self.compute_code_belief(code)
-        comparator = get_comparator(mode)
-        candidates = sorted(
-                range(len(self.l_msgs)),
-                key=lambda i: comparator(
-                    code_belief, self.l_beliefs[i], 
-                    code_weights, self.l_weights[i],
-                ))
-        return [self.l_msgs[c] for c in candidates[:10]]
+        return self._translate(
+                "c", code, mode, lambda: self.compute_code_belief(code),
+                self.l_set, self.l_msgs)
+
+    def l_to_c_batch(self, l_msgs, mode):
+        assert all(l_msg.any() for l_msg in l_msgs)
+        return self._translate_batch(
+                "l", l_msgs, mode, self.compute_l_beliefs, self.model_set,
+                self.codes)
+
+    def c_to_l_batch(self, codes, mode):
+        results = [[[0]] for _ in codes]
+        nonzero = [i for i, code in enumerate(codes) if code.any()]
+        translations = self._translate_batch(
+                "c", [codes[i] for i in nonzero], mode,
+                self.compute_code_beliefs, self.l_set, self.l_msgs)
+        for i, translation in zip(nonzero, translations):
+            results[i] = translation
+        return results
+
+def load(directory, key, ph, translator, task, session, config):
+    state_path = os.path.join(directory, "state.pkl")
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, "rb") as state_f:
+        state = pickle.load(state_f)
+    if state["key"] != key:
+        return None
+    saved = {"distractors": state["distractors"]}
+    for name in ARTIFACT_ARRAYS:
+        # plain ndarray views of the maps; indexing np.memmap itself is slow
+        saved[name] = np.asarray(np.load(
+                os.path.join(directory, name + ".npy"), mmap_mode="r"))
+    return Lexicographer(
+            state["states"], saved["codes"], state["l_msgs"], ph, translator,
+            task, session, config, saved)
+
+# identifies the trained weights and the settings the lexicon depends on;
+# the translation mode and index only matter at query time
+def _artifact_key(config, checkpoint_dir):
+    checkpoint = sorted(
+            (name, os.path.getsize(os.path.join(checkpoint_dir, name)),
+                os.path.getmtime(os.path.join(checkpoint_dir, name)))
+            for name in os.listdir(checkpoint_dir)
+            if name.startswith("model"))
+    lex_settings = {
+            k: v for k, v in vars(config.lexicographer).items()
+            if k not in ("mode", "index")}
+    return {
+        "checkpoint": checkpoint,
+        "task": config.task.name,
+        "channel": sorted(vars(config.channel).items()),
+        "translator": sorted(vars(config.translator).items()),
+        "lexicographer": sorted(lex_settings.items()),
+        "trainer": (config.trainer.n_batch_episodes,
+            config.trainer.n_distractors)
+    }
 
 def run(task, rollout_ph, reconst_ph, model, desc_model, translator, session,
         config):
     assert task.n_agents == 2
+    directory = trainer.checkpoint_dir(config) + "/lexicon"
+    key = _artifact_key(config, trainer.checkpoint_dir(config))
+    lex = load(directory, key, reconst_ph, translator, task, session, config)
+    if lex is not None:
+        logging.info("[lexicon]\tloaded %s" % directory)
+        return lex
+
     random = np.random.RandomState(3951)
 
-    h0, z0, _ = session.run(model.zero_state(1, tf.float32))
+    n_states = config.trainer.n_batch_episodes
+    n_codes = config.lexicographer.n_codes
+    h0, z0, _ = session.run(model.zero_state(n_states, tf.float32))
     states = []
     codes = []
     #l_msgs = task.lexicon[1:]
@@ -176,8 +440,8 @@ def run(task, rollout_ph, reconst_ph, model, desc_model, translator, session,
         while True:
             replay = []
             rew = trainer._do_rollout(
-                    task, rollout_ph, model, desc_model, replay, [], session,
-                    config, 10000, h0, z0, "val")
+                    task, rollout_ph, model, desc_model, replay, session,
+                    config, 10000, h0, z0, "val", n_episodes=n_states)
             #print rew[1]
             #replay = [task.get_demonstration("val")]
 
@@ -192,7 +456,7 @@ def run(task, rollout_ph, reconst_ph, model, desc_model, translator, session,
                 #    if len(states) >= config.trainer.n_batch_episodes:
                 #    #if len(states) > 2000:
                 #        raise Break()
-                if len(states) >= config.trainer.n_batch_episodes:
+                if len(states) >= n_states and len(codes) >= n_codes:
                     raise Break()
     except Break:
         pass
@@ -214,9 +478,11 @@ def run(task, rollout_ph, reconst_ph, model, desc_model, translator, session,
     ####print l_msgs
     ####exit()
 
-    codes = codes[:50]
-    #states = states[:256]
+    codes = codes[:n_codes]
+    states = states[:n_states]
 
-    return Lexicographer(
+    lex = Lexicographer(
             states, codes, l_msgs, reconst_ph, translator, task, session,
             config)
+    lex.save(directory, key)
+    return lex
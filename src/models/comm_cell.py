@@ -5,8 +5,10 @@ import tensorflow as tf
 class CommCell(tf.nn.rnn_cell.RNNCell):
     def __init__(
             self, n_agents, n_hidden, n_comm, n_out, channel, communicate,
-            symmetric, feature_depth):
+            symmetric, feature_depth, n_features=None):
         self.n_agents = n_agents
+        # only needed when inputs arrive as (index, value) pairs
+        self.n_features = n_features
         self.n_hidden = n_hidden
         self.n_comm = n_comm
         self.n_out = n_out if isinstance(n_out, tuple) else (n_out,) * n_agents
@@ -35,11 +37,18 @@ class CommCell(tf.nn.rnn_cell.RNNCell):
     def output_size(self):
         return self.state_size
 
-    def __call__(self, inputs, state, scope=None):
+    # noise is one standard normal tensor per agent for its transmitted
+    # message; by default the channel draws its own
+    def __call__(self, inputs, state, scope=None, noise=None):
         assert len(inputs) == self.n_agents
         assert len(state) == 3
         assert all(len(s) == self.n_agents for s in state)
         states, comms, _ = state
+        # dynamic_rnn gives every input the dtype of the first one, so sparse
+        # indices may arrive as floats
+        inputs = tuple(
+                (tf.to_int32(x[0]), x[1]) if isinstance(x, tuple) else x
+                for x in inputs)
 
         with tf.variable_scope(scope or "comm_cell"):
             features = []
@@ -49,8 +58,12 @@ class CommCell(tf.nn.rnn_cell.RNNCell):
                     other_comms = tuple(
                             comms[_ia] for _ia in range(self.n_agents)
                             if _ia != i_agent)
-                    features.append(
-                            tf.concat(1, (inputs[i_agent],) + other_comms))
+                    if isinstance(inputs[i_agent], tuple):
+                        features.append((inputs[i_agent],
+                                tf.concat(1, other_comms)))
+                    else:
+                        features.append((None, tf.concat(
+                                1, (inputs[i_agent],) + other_comms)))
             else:
                 # for fair comparison, let non-communicating agents use the
                 # extra channel capacity for themselves
@@ -58,7 +71,10 @@ class CommCell(tf.nn.rnn_cell.RNNCell):
                 #        self.n_hidden + self.n_comm * (self.n_agents - 1))
                 base_cell = tf.nn.rnn_cell.GRUCell(self.n_hidden)
                 for i_agent in range(self.n_agents):
-                    features.append(inputs[i_agent])
+                    if isinstance(inputs[i_agent], tuple):
+                        features.append((inputs[i_agent], None))
+                    else:
+                        features.append((None, inputs[i_agent]))
 
             next_states = []
             next_comms = []
@@ -66,10 +82,14 @@ class CommCell(tf.nn.rnn_cell.RNNCell):
             for i_agent in range(self.n_agents):
                 with tf.variable_scope(self.agent_scopes[i_agent],
                         reuse=(i_agent > 0 and self.reuse_agent_scope)):
+                    sparse_obs, dense_features = features[i_agent]
+                    sparse_in = None
+                    if sparse_obs is not None:
+                        sparse_in = sparse_obs + (self.n_features,)
                     hidden, _ = net.mlp(
-                            features[i_agent],
+                            dense_features,
                             (self.n_hidden,) * self.feature_depth,
-                            final_nonlinearity=True)
+                            final_nonlinearity=True, sparse_in=sparse_in)
                     _, next_state = base_cell(hidden, states[i_agent])
                     with tf.variable_scope("comm"):
                         next_comm, _ = net.mlp(next_state, (self.n_comm,))
@@ -80,7 +100,11 @@ class CommCell(tf.nn.rnn_cell.RNNCell):
                     next_comms.append(next_comm)
                     next_outs.append(next_out)
 
-            transmitted = [self.channel.transmit(c) for c in next_comms]
+            if noise is None:
+                noise = (None,) * self.n_agents
+            transmitted = [
+                    self.channel.transmit(c, n)
+                    for c, n in zip(next_comms, noise)]
 
         next_state = (tuple(next_states), tuple(transmitted), tuple(next_outs))
         return next_state, next_state
@@ -3,17 +3,34 @@ import net
 
 import tensorflow as tf
 
+def _float_indices(t_x_sparse):
+    return tuple((tf.to_float(t_index), t_value)
+            for t_index, t_value in t_x_sparse)
+
 class RecurrentQModel(object):
     def build(self, task, rollout_ph, replay_ph, channel, config):
         cell = CommCell(
                 task.n_agents, config.model.n_hidden, config.channel.n_msg,
                 task.n_actions, channel, communicate=config.model.communicate,
                 symmetric=task.symmetric,
-                feature_depth=config.model.feature_depth)
+                feature_depth=config.model.feature_depth,
+                n_features=task.n_features)
+
+        if config.model.sparse_obs:
+            # dynamic_rnn would cast the float values to the int32 indices'
+            # dtype, so the indices go in as (exact) floats instead and the
+            # cell casts them back
+            replay_x = _float_indices(replay_ph.t_x_sparse)
+            replay_x_next = _float_indices(replay_ph.t_x_next_sparse)
+            rollout_x = rollout_ph.t_x_sparse
+        else:
+            replay_x = replay_ph.t_x
+            replay_x_next = replay_ph.t_x_next
+            rollout_x = rollout_ph.t_x
 
         with tf.variable_scope("net") as scope:
             tt_replay_states, _ = tf.nn.dynamic_rnn(
-                    cell, replay_ph.t_x, dtype=tf.float32, scope=scope,
+                    cell, replay_x, dtype=tf.float32, scope=scope,
                     initial_state=(replay_ph.t_h, replay_ph.t_z,
                         replay_ph.t_fake_q))
             tt_replay_h, tt_replay_z, tt_replay_q = tt_replay_states
@@ -21,8 +38,9 @@ class RecurrentQModel(object):
             scope.reuse_variables()
 
             tt_rollout_states, _ = cell(
-                    rollout_ph.t_x,
-                    (rollout_ph.t_h, rollout_ph.t_z, rollout_ph.t_fake_q))
+                    rollout_x,
+                    (rollout_ph.t_h, rollout_ph.t_z, rollout_ph.t_fake_q),
+                    noise=rollout_ph.t_noise)
             tt_rollout_h, tt_rollout_z, tt_rollout_q = tt_rollout_states
 
             v_net = tf.get_collection(
@@ -30,7 +48,7 @@ class RecurrentQModel(object):
 
         with tf.variable_scope("net_next") as scope:
             tt_replay_states_next, _ = tf.nn.dynamic_rnn(
-                    cell, replay_ph.t_x_next, dtype=tf.float32, scope=scope,
+                    cell, replay_x_next, dtype=tf.float32, scope=scope,
                     initial_state=(replay_ph.t_h_next, replay_ph.t_z_next, 
                         replay_ph.t_fake_q))
             tt_replay_h_next, tt_replay_z_next, tt_replay_q_next = \
@@ -39,7 +57,10 @@ class RecurrentQModel(object):
             v_net_next = tf.get_collection(
                     tf.GraphKeys.GLOBAL_VARIABLES, scope=scope.name)
 
+        t_weight = tf.expand_dims(replay_ph.t_weight, 1)
+        t_steps = tf.reduce_sum(replay_ph.t_mask, axis=1)
         tt_td = []
+        tt_slice_td = []
         tt_loss = []
         tt_comm_loss = []
         for t_q, t_q_next, t_action, t_z in zip(
@@ -50,7 +71,10 @@ class RecurrentQModel(object):
                 + replay_ph.t_reward
                 - tf.reduce_sum(t_q * t_action, axis=2))
             tt_td.append(t_td)
-            tt_loss.append(tf.reduce_mean(replay_ph.t_mask * tf.square(t_td)))
+            tt_slice_td.append(tf.reduce_sum(
+                    replay_ph.t_mask * tf.abs(t_td), axis=1) / t_steps)
+            tt_loss.append(tf.reduce_mean(
+                    t_weight * replay_ph.t_mask * tf.square(t_td)))
             tt_comm_loss.append(tf.reduce_mean(tf.square(t_z)))
 
         # TODO configurable
@@ -64,6 +88,7 @@ class RecurrentQModel(object):
         self.tt_rollout_z = tt_rollout_z
         self.tt_rollout_q = tt_rollout_q
         self.t_loss = t_loss
-        self.t_train_op = optimizer.minimize(t_loss, var_list=v_net)
+        self.t_slice_td = tf.add_n(tt_slice_td)
+        self.t_train_op = net.minimize(optimizer, t_loss, v_net)
         self.oo_update_target = [
                 vn.assign(v) for v, vn in zip(v_net, v_net_next)]
@@ -4,6 +4,7 @@ class TrivialModel(object):
     def build(self, task, rollout_ph, replay_ph, channel, config):
         self.t_loss = tf.zeros(())
         self.t_train_op = tf.zeros((1,))
+        self.t_slice_td = tf.zeros((config.trainer.n_batch_episodes,))
         self.oo_update_target = []
         self.tt_rollout_h = [tf.zeros((1, config.model.n_hidden))] * task.n_agents
         self.tt_rollout_z = [tf.zeros((1, config.channel.n_msg))] * task.n_agents
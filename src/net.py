@@ -2,9 +2,15 @@ import tensorflow as tf
 
 RELU_SCALE = 1.43
 
-def mlp(t_in, widths, final_nonlinearity=False):
+# sparse_in = (t_index, t_value, n_features) describes the first n_features
+# input columns as (index, value) pairs; t_in (possibly None) holds the rest.
+# The first layer then sums the looked-up weight rows instead of multiplying
+# by a mostly-zero dense input, with the same variables as the dense version.
+def mlp(t_in, widths, final_nonlinearity=False, sparse_in=None):
     weights = []
-    prev_width = t_in.get_shape()[-1]
+    prev_width = 0 if t_in is None else t_in.get_shape()[-1].value
+    if sparse_in is not None:
+        prev_width += sparse_in[2]
     prev_layer = t_in
     for i_layer, width in enumerate(widths):
         v_w = tf.get_variable("w%d" % i_layer, shape=(prev_width, width),
@@ -14,7 +20,15 @@ def mlp(t_in, widths, final_nonlinearity=False):
                 initializer=tf.constant_initializer(0.0))
         weights += [v_w, v_b]
 
-        t_layer = batch_matmul(prev_layer, v_w) + v_b
+        if i_layer == 0 and sparse_in is not None:
+            t_index, t_value, n_sparse = sparse_in
+            t_rows = tf.nn.embedding_lookup(v_w, t_index)
+            t_layer = tf.reduce_sum(
+                    t_rows * tf.expand_dims(t_value, -1), axis=-2) + v_b
+            if prev_layer is not None:
+                t_layer += batch_matmul(prev_layer, v_w[n_sparse:])
+        else:
+            t_layer = batch_matmul(prev_layer, v_w) + v_b
         if final_nonlinearity or i_layer < len(widths) - 1:
             #t_layer = tf.nn.relu(t_layer)
             t_layer = tf.nn.tanh(t_layer)
@@ -22,6 +36,25 @@ def mlp(t_in, widths, final_nonlinearity=False):
         prev_width = width
     return prev_layer, weights
 
+# optimizer.minimize, except that IndexedSlices gradients (from the sparse
+# first layer) are summed into dense ones first. They repeat rows, and Adam's
+# sparse update squares each slice before adding them up, so training would
+# differ from the dense version.
+def minimize(optimizer, t_loss, var_list):
+    grads = optimizer.compute_gradients(t_loss, var_list=var_list)
+    dense_grads = []
+    for g, v in grads:
+        if isinstance(g, tf.IndexedSlices):
+            g = tf.unsorted_segment_sum(
+                    g.values, g.indices, v.get_shape()[0].value)
+        dense_grads.append((g, v))
+    return optimizer.apply_gradients(dense_grads)
+
+def densify(t_index, t_value, n_features):
+    return tf.reduce_sum(
+            tf.one_hot(t_index, n_features) * tf.expand_dims(t_value, -1),
+            axis=-2)
+
 def embed(t_in, n_embeddings, size, multi=False):
     if multi:
         varz = [tf.get_variable("embed%d" % i, shape=(n_embeddings, size),
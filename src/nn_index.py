@@ -0,0 +1,67 @@
+import util
+
+import numpy as np
+from scipy.misc import logsumexp
+
+# Indices over the rows v_i of an (N, batch) array of log-vectors, returning
+# the k rows with the highest logsumexp(q + v_i) for a query log-vector q.
+# The lexicographer's dot and pmi comparators both have this form.
+
+load = util.class_loader("nn_index", lambda c: c.lexicographer.index)
+
+N_PROBE = 8
+N_KMEANS_ITERS = 10
+
+# indices of the k lowest scores, in order, ties broken by index
+def top_k(scores, k):
+    if k < len(scores):
+        # argpartition picks arbitrarily among scores tied with the k-th, so
+        # keep all of them and let the sort break the tie
+        threshold = np.partition(scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores <= threshold)
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.lexsort((candidates, scores[candidates]))][:k]
+
+class ExactIndex(object):
+    def build(self, log_vectors):
+        self.log_vectors = np.asarray(log_vectors)
+
+    def search(self, query, k):
+        scores = logsumexp(self.log_vectors + query, axis=1)
+        return top_k(-scores, k)
+
+class ClusterIndex(object):
+    # Approximate: rows are grouped by k-means on their normalized vectors,
+    # and a query is only scored exactly against the members of the N_PROBE
+    # clusters whose centroids score best, about sqrt(N) rows each.
+    def build(self, log_vectors):
+        self.log_vectors = np.asarray(log_vectors)
+        n_rows = len(self.log_vectors)
+        n_clusters = max(1, int(np.sqrt(n_rows)))
+        probs = np.exp(self.log_vectors
+                - logsumexp(self.log_vectors, axis=1)[:, np.newaxis])
+
+        random = np.random.RandomState(0)
+        centroids = probs[random.choice(n_rows, n_clusters, replace=False)]
+        for _ in range(N_KMEANS_ITERS):
+            distances = (
+                    np.sum(centroids ** 2, axis=1)[np.newaxis, :]
+                    - 2 * probs.dot(centroids.T))
+            assignment = np.argmin(distances, axis=1)
+            for i_cluster in range(n_clusters):
+                members = probs[assignment == i_cluster]
+                if len(members) > 0:
+                    centroids[i_cluster] = np.mean(members, axis=0)
+
+        self.log_centroids = np.log(np.maximum(centroids, np.finfo(float).tiny))
+        self.members = [
+                np.flatnonzero(assignment == i_cluster)
+                for i_cluster in range(n_clusters)]
+
+    def search(self, query, k):
+        centroid_scores = logsumexp(self.log_centroids + query, axis=1)
+        probe = top_k(-centroid_scores, N_PROBE)
+        candidates = np.concatenate([self.members[i] for i in probe])
+        scores = logsumexp(self.log_vectors[candidates] + query, axis=1)
+        return candidates[top_k(-scores, k)]
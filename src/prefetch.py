@@ -0,0 +1,61 @@
+import Queue
+import sys
+import threading
+
+_STOP = object()
+
+class Prefetcher(object):
+    # Calls build(item) on a background thread for every item passed to
+    # put() and hands the results back in order through get(). At most
+    # maxsize items wait to be built and maxsize built results wait to be
+    # taken; past that put() blocks, so take results before putting more.
+    # build runs alongside the caller, so anything it touches besides the
+    # item (the trainer's builds draw distractors from the task's "val" RNG
+    # and cache) must be left alone until close() has returned.
+    def __init__(self, build, maxsize):
+        self.build = build
+        self.items = Queue.Queue(maxsize)
+        self.results = Queue.Queue(maxsize)
+        self.n_pending = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.items.get()
+            if item is _STOP:
+                return
+            try:
+                result = (self.build(item), None)
+            except Exception:
+                result = (None, sys.exc_info())
+            self.results.put(result)
+
+    def put(self, item):
+        self.n_pending += 1
+        self.items.put(item)
+
+    def get(self):
+        result, error = self.results.get()
+        self.n_pending -= 1
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return result
+
+    # pending items are still built, and their results dropped; both queues
+    # may be full, so keep emptying results until the thread has stopped
+    def close(self):
+        stopping = False
+        while self.thread.is_alive():
+            if not stopping:
+                try:
+                    self.items.put_nowait(_STOP)
+                    stopping = True
+                except Queue.Full:
+                    pass
+            try:
+                self.results.get(timeout=0.01)
+            except Queue.Empty:
+                pass
+        self.thread.join()
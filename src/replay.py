@@ -0,0 +1,113 @@
+import numpy as np
+
+PRIORITY_EPS = 1e-3
+
+class ReplayMemory(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.episodes = [None] * capacity
+        self.lengths = np.zeros(capacity, dtype=np.int32)
+        self.good = np.zeros(capacity, dtype=bool)
+        self.n_good = 0
+        self.size = 0
+        self.next = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        return self.episodes[index]
+
+    def append(self, episode):
+        index = self.next
+        good = bool(np.any(episode.reward > 0))
+        self.n_good += int(good) - int(self.good[index])
+        self.episodes[index] = episode
+        self.lengths[index] = len(episode)
+        self.good[index] = good
+        self.next = (index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return index
+
+    def extend(self, episodes):
+        for episode in episodes:
+            self.append(episode)
+
+    def sample(self, n, random):
+        return random.randint(self.size, size=n)
+
+    def sample_good(self, n, random):
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        good_indices = np.flatnonzero(self.good)
+        return good_indices[random.randint(len(good_indices), size=n)]
+
+    def sample_offsets(self, indices, n_history, random):
+        bounds = np.maximum(1, self.lengths[indices] - n_history)
+        return (random.rand(len(indices)) * bounds).astype(np.int32)
+
+    def weights(self, indices):
+        return np.ones(len(indices))
+
+    def update_priorities(self, indices, td_errors):
+        pass
+
+class SumTree(object):
+    def __init__(self, capacity):
+        # leaves live in the second half of the array; padding the leaf count
+        # to a power of two keeps every leaf at the same depth
+        self.n_leaves = 1 << max(0, int(capacity - 1).bit_length())
+        self.depth = int(self.n_leaves).bit_length() - 1
+        self.nodes = np.zeros(2 * self.n_leaves)
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, indices):
+        return self.nodes[self.n_leaves + np.asarray(indices)]
+
+    def update(self, indices, priorities):
+        nodes = self.n_leaves + np.asarray(indices)
+        self.nodes[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+
+    def find(self, values):
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.nodes[2 * nodes]
+            go_right = values >= left
+            values -= np.where(go_right, left, 0)
+            nodes = 2 * nodes + go_right
+        return nodes - self.n_leaves
+
+class PrioritizedReplayMemory(ReplayMemory):
+    def __init__(self, capacity, alpha, beta):
+        super(PrioritizedReplayMemory, self).__init__(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.
+
+    def append(self, episode):
+        index = super(PrioritizedReplayMemory, self).append(episode)
+        self.tree.update([index], [self.max_priority ** self.alpha])
+        return index
+
+    def sample(self, n, random):
+        # stratified: one draw from each of n equal slices of the total mass
+        values = (np.arange(n) + random.rand(n)) * self.tree.total() / n
+        # rounding can push a draw past the last occupied leaf
+        return np.minimum(self.tree.find(values), self.size - 1)
+
+    def weights(self, indices):
+        probs = self.tree.get(indices) / self.tree.total()
+        weights = (self.size * probs) ** -self.beta
+        return weights / np.max(weights)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + PRIORITY_EPS
+        self.max_priority = max(self.max_priority, np.max(priorities))
+        self.tree.update(indices, priorities ** self.alpha)
@@ -6,6 +6,7 @@ from util import Break
 import logging
 import numpy as np
 import tensorflow as tf
+import time
 
 random = np.random.RandomState(8935)
 
@@ -30,7 +31,7 @@ def get_c_samples(count, task, rollout_ph, model, desc_model, session, config,
         while True:
             replay = []
             rew = trainer._do_rollout(
-                    task, rollout_ph, model, desc_model, replay, [], session,
+                    task, rollout_ph, model, desc_model, replay, session,
                     config, 10000, h0, z0, fold)
 
             for episode in replay:
@@ -50,13 +51,11 @@ def make_feed_vars(states, task, config):
     xa_noise = np.zeros(
             (config.trainer.n_batch_episodes, config.trainer.n_distractors,
                 task.n_features))
-    for i, state in enumerate(states):
-        xb[i, :] = state.obs()[1]
-        xa_true[i, :] = state.obs()[0]
-        distractors = task.distractors_for(state, 1, config.trainer.n_distractors)
-        for i_dis in range(len(distractors)):
-            dis, _ = distractors[i_dis]
-            xa_noise[i, i_dis, :] = dis.obs()[0]
+    n = len(states)
+    xb[:n] = [state.obs()[1] for state in states]
+    xa_true[:n] = [state.obs()[0] for state in states]
+    xa_noise[:n] = task.distractor_obs(
+            states, 1, config.trainer.n_distractors)[:, :, 0, :]
     
     return xb, xa_true, xa_noise
 
@@ -118,8 +117,10 @@ def run(task, rollout_ph, reconst_ph, model, desc_model, translator,
         print >>eval_f
 
         for mode in ["fkl", "rkl", "pmi", "dot", "rand"]:
-            tr_c = [lexicographer.l_to_c(l, mode)[0] for l in l_msgs]
-            tr_l_pre = [lexicographer.c_to_l(c, mode)[:5] for c in c_msgs]
+            start = time.time()
+            tr_c = [c[0] for c in lexicographer.l_to_c_batch(l_msgs, mode)]
+            tr_l_pre = [
+                    l[:5] for l in lexicographer.c_to_l_batch(c_msgs, mode)]
             tr_l = [np.zeros(len(task.lexicon)) for _ in range(len(tr_l_pre))]
             for i in range(len(tr_l)):
                 for l_word in tr_l_pre[i]:
@@ -136,6 +137,7 @@ def run(task, rollout_ph, reconst_ph, model, desc_model, translator,
             
             logging.info("[l-c:%s]\t%s" % (mode, str(c_success)))
             logging.info("[c-l:%s]\t%s" % (mode, str(l_success)))
+            logging.info("[time:%s]\t%2.2fs" % (mode, time.time() - start))
             logging.info("")
             print >>eval_f, mode + ":"
             print >>eval_f, "(l-c)", c_success
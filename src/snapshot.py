@@ -0,0 +1,154 @@
+from experience import Experience, Episode
+
+import cPickle as pickle
+import numpy as np
+import os
+import shutil
+
+# A snapshot is a directory of .npy files (one per concatenated episode
+# field, loaded memory-mapped) plus a pickle with everything small: replay
+# bookkeeping, RNG states and whatever the caller passes in.
+
+ARRAY_FIELDS = [f for f in Episode.FIELDS if f != "experiences"]
+
+def save(directory, task, replay, demonstrations, extra):
+    tmp_directory = directory + ".tmp"
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    os.mkdir(tmp_directory)
+
+    state = {"extra": extra}
+    replay_state = dict(vars(replay))
+    del replay_state["episodes"]
+    state["replay"] = replay_state
+    state["replay_episodes"] = _save_episodes(
+            tmp_directory, "replay", replay.episodes[:replay.size], task)
+
+    # demonstrations usually point into the task's fixed pool of traces, so
+    # storing their positions is enough
+    pool = getattr(task, "train_demonstrations", [])
+    pool_index = {id(demo): i for i, demo in enumerate(pool)}
+    if all(id(demo) in pool_index for demo in demonstrations):
+        np.save(os.path.join(tmp_directory, "demo_ids.npy"),
+                np.asarray([pool_index[id(d)] for d in demonstrations],
+                    dtype=np.int32))
+        state["demo_episodes"] = None
+    else:
+        state["demo_episodes"] = _save_episodes(
+                tmp_directory, "demo", demonstrations, task)
+
+    state["task_randoms"] = {
+            name: getattr(task, name) for name in ("random", "randoms")
+            if hasattr(task, name)}
+
+    with open(os.path.join(tmp_directory, "state.pkl"), "wb") as state_f:
+        pickle.dump(state, state_f, pickle.HIGHEST_PROTOCOL)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(tmp_directory, directory)
+
+def load(directory, task, replay, demonstrations):
+    with open(os.path.join(directory, "state.pkl"), "rb") as state_f:
+        state = pickle.load(state_f)
+
+    replay_state = state["replay"]
+    assert replay_state["capacity"] == replay.capacity, \
+            "snapshot has replay capacity %d" % replay_state["capacity"]
+    episodes = _load_episodes(
+            directory, "replay", state["replay_episodes"], task)
+    vars(replay).update(replay_state)
+    replay.episodes = episodes + [None] * (replay.capacity - len(episodes))
+
+    if state["demo_episodes"] is None:
+        demo_ids = np.load(os.path.join(directory, "demo_ids.npy"))
+        demonstrations[:] = [task.train_demonstrations[i] for i in demo_ids]
+    else:
+        demonstrations[:] = _load_episodes(
+                directory, "demo", state["demo_episodes"], task)
+
+    for name, value in state["task_randoms"].items():
+        setattr(task, name, value)
+
+    return state["extra"]
+
+def _save_episodes(directory, prefix, episodes, task):
+    def path(name):
+        return os.path.join(directory, "%s_%s.npy" % (prefix, name))
+
+    info = {"lengths": [len(ep) for ep in episodes], "fields": []}
+    if len(episodes) == 0:
+        return info
+    for field in ARRAY_FIELDS:
+        if getattr(episodes[0], field) is None:
+            continue
+        np.save(path(field),
+                np.concatenate([getattr(ep, field) for ep in episodes]))
+        info["fields"].append(field)
+    # the episode arrays hold float32 rewards for the replay feeds; keep the
+    # experiences' own values so replay after a resume sees the same data
+    np.save(path("r"),
+            np.asarray([e.r for ep in episodes for e in ep], dtype=np.float64))
+
+    states1 = [e.s1 for ep in episodes for e in ep]
+    states2 = [e.s2 for ep in episodes for e in ep]
+    if hasattr(task, "pack_states"):
+        for name, states in (("s1", states1), ("s2", states2)):
+            packed = task.pack_states(states)
+            for key, array in packed.items():
+                np.save(path("%s_%s" % (name, key)), array)
+        info["packed"] = list(packed)
+    else:
+        info["packed"] = None
+        info["states"] = (states1, states2)
+    return info
+
+def _load_episodes(directory, prefix, info, task):
+    # plain ndarray views of the maps; indexing np.memmap itself is slow
+    def load_array(name):
+        return np.asarray(np.load(
+                os.path.join(directory, "%s_%s.npy" % (prefix, name)),
+                mmap_mode="r"))
+
+    lengths = info["lengths"]
+    if len(lengths) == 0:
+        return []
+    data = {field: load_array(field) for field in info["fields"]}
+    rewards = load_array("r")
+    if info["packed"] is not None:
+        states1, states2 = (
+                task.unpack_states(
+                    {key: load_array("%s_%s" % (name, key))
+                        for key in info["packed"]},
+                    data[l_msg_field])
+                for name, l_msg_field in (
+                    ("s1", "l_msg"), ("s2", "l_msg_next")))
+    else:
+        states1, states2 = info["states"]
+
+    episodes = []
+    offset = 0
+    for length in lengths:
+        episode = Episode.__new__(Episode)
+        for field in ARRAY_FIELDS:
+            value = None
+            if field in data:
+                value = data[field][offset:offset+length]
+            setattr(episode, field, value)
+
+        experiences = []
+        for t in range(length):
+            m1 = m2 = None
+            if episode.h is not None:
+                m1 = (list(episode.h[t]), list(episode.z[t]),
+                        list(episode.l_h[t]))
+                m2 = (list(episode.h_next[t]), list(episode.z_next[t]),
+                        list(episode.l_h_next[t]))
+            experiences.append(Experience(
+                states1[offset+t], m1, tuple(episode.action[t].tolist()),
+                states2[offset+t], m2, float(rewards[offset+t]),
+                bool(episode.terminal[t])))
+        episode.experiences = experiences
+        episodes.append(episode)
+        offset += length
+    return episodes
@@ -1,4 +1,5 @@
 from ref import RefTask
+from util import LexiconMatcher
 
 from collections import defaultdict
 import csv
@@ -79,18 +80,13 @@ class BirdsRefTask(RefTask):
 
         discarded = []
         self.reps = {}
-        for k, desc in anns.items():
-            rep = np.zeros(len(self.lexicon))
-            out = []
-            for i_l, l in enumerate(self.lexicon):
-                if all(self.reverse_vocab[w] in desc for w in l):
-                    rep[i_l] = 1
-                    out += l
-            if len(out) == 0:
+        matcher = LexiconMatcher(self.lexicon, self.reverse_vocab)
+        ann_keys = anns.keys()
+        reps = matcher.reps([anns[k] for k in ann_keys])
+        for k, rep in zip(ann_keys, reps):
+            if not rep.any():
                 discarded.append(k)
                 continue
-            assert rep.any()
-            rep /= np.sum(rep)
             self.reps[k] = rep
         for k in discarded:
             del anns[k]
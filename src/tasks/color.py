@@ -1,5 +1,6 @@
 from data.color import munroecorpus
 from ref import RefTask
+from util import LexiconMatcher
 
 import cairo
 import colorsys
@@ -59,18 +60,14 @@ class ColorRefTask(RefTask):
         self.empty_desc = np.zeros(len(self.lexicon))
         self.empty_desc[0] = 1
 
-        for name in train_corpus[0]:
-            words = name.replace("-", " ").split(" ")
-            rep = np.zeros(len(self.lexicon))
-            out = []
-            for i_l, l in enumerate(self.lexicon):
-                if all(self.reverse_vocab[w] in words for w in l):
-                    rep[i_l] = 1
-                    out += l
+        matcher = LexiconMatcher(self.lexicon, self.reverse_vocab)
+        names = list(train_corpus[0])
+        reps = matcher.reps(
+                [name.replace("-", " ").split(" ") for name in names])
+        for name, rep in zip(names, reps):
+            out = [w for i_l in np.flatnonzero(rep) for w in self.lexicon[i_l]]
             if len(out) == 0:
                 continue
-            assert rep.any()
-            rep /= np.sum(rep)
 
             files = [c[name] for c in train_corpus]
             colors = np.array([munroecorpus.open_datafile(f) for f in files]).T
@@ -104,6 +101,13 @@ class ColorRefTask(RefTask):
         self.randoms["val"] = np.random.RandomState(0)
         self.randoms["test"] = np.random.RandomState(0)
 
+    def reseed(self, offset):
+        super(ColorRefTask, self).reseed(offset)
+        self.randoms = {
+            fold: np.random.RandomState((0, offset))
+            for fold in ("train", "val", "test")
+        }
+
     def get_pair(self, fold):
         colors = self.colors[fold]
         reps = self.reps[fold]
@@ -1,6 +1,8 @@
-from experience import Experience
+from experience import Experience, Episode
+from util import LexiconMatcher
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+import hashlib
 import json
 import numpy as np
 import os
@@ -66,29 +68,68 @@ N_LEX = 83
 MAPS = [MAP_1, MAP_2, MAP_3, MAP_4, MAP_5]
 MAP_SHAPE = (8, 8)
 
+DISTRACTOR_CACHE_SIZE = 20000
+
+TRACE_DIR = "data/drive/server_logs"
+# parsed and simulated traces, one file per state of TRACE_DIR; bump the
+# version whenever the parsing below changes
+TRACE_CACHE_DIR = "data/drive/trace_cache"
+TRACE_CACHE_VERSION = 1
+
+FOLD_SEEDS = {"train": 1290, "val": 1482, "test": 9424}
+
 DIRS = {"n": 0, "e": 1, "s": 2, "w": 3}
 
+# unit moves for each heading, and the change in heading for each action
+HEADING_STEPS = ((-1, 0), (0, 1), (1, 0), (0, -1))
+ACTION_TURN_STEPS = (0, 0, -1, 1)
+
 Car = namedtuple("Car", ["pos", "dir", "goal", "done"])
 
+# a map parsed once: the road grid, start cells (in row-major order) with
+# their headings, goal cells and road cells
+MapTemplate = namedtuple(
+        "MapTemplate", ["road", "starts", "start_dirs", "goals", "road_cells"])
+
+def _compile_map(map_str):
+    rows = map_str.split("\n")[1:-1]
+    road = np.asarray(
+            [[0 if ch == "#" else 1 for ch in row] for row in rows],
+            dtype=np.float64)
+    cells = [(r, c) for r in range(MAP_SHAPE[0]) for c in range(MAP_SHAPE[1])]
+    starts = [(r, c) for r, c in cells if rows[r][c] in DIRS]
+    return MapTemplate(
+            road, starts, [DIRS[rows[r][c]] for r, c in starts],
+            [(r, c) for r, c in cells if rows[r][c] == "*"],
+            [(r, c) for r, c in cells if road[r, c]])
+
+TEMPLATES = [_compile_map(map_str) for map_str in MAPS]
+
 N_FEATURES = (
     len(MAPS)
     + MAP_SHAPE[0] * MAP_SHAPE[1] * 2
     + 1
     + len(DIRS))
 
+# a live car's observation has exactly four nonzero features: map, position,
+# goal and heading
+POS_OFFSET = len(MAPS)
+GOAL_OFFSET = POS_OFFSET + MAP_SHAPE[0] * MAP_SHAPE[1]
+DIR_OFFSET = GOAL_OFFSET + MAP_SHAPE[0] * MAP_SHAPE[1] + 1
+N_OBS_INDICES = 4
 
 class DriveTask(object):
     def __init__(self):
         #self.random = np.random.RandomState(0)
         self.randoms = {
-            "train": np.random.RandomState(1290),
-            "val": np.random.RandomState(1482),
-            "test": np.random.RandomState(9424)
+            fold: np.random.RandomState(seed)
+            for fold, seed in FOLD_SEEDS.items()
         }
         self.n_agents = 2
         self.symmetric = True
         self.n_actions = (4, 4)
         self.n_features = N_FEATURES
+        self.n_obs_indices = N_OBS_INDICES
         #self.vocab = {"_": 0, "UNK": 1}
         #self.reverse_vocab = {0: "_", 1: "UNK"}
         #self.lexicon = [[0]]
@@ -97,25 +138,55 @@ class DriveTask(object):
         self.reverse_vocab = {0: "_", 1: "UNK", 2: "done"}
         self.lexicon = [[0], [2]]
 
-        self.roads = []
-        for map_str in MAPS:
-            template = map_str.split("\n")[1:-1]
-            road = np.zeros(MAP_SHAPE)
-            for r in range(MAP_SHAPE[0]):
-                for c in range(MAP_SHAPE[1]):
-                    road[r, c] = 0 if template[r][c] == "#" else 1
-            self.roads.append(road)
+        self.roads = [template.road for template in TEMPLATES]
 
         self.train_demonstrations, self.test_demonstrations = self.load_traces()
         self.test_counter = 0
+        self.distractor_cache = OrderedDict()
         #self.max_desc_len = max(len(d) for dem in self.demonstrations for ex in
         #        dem for d in ex.s1.desc)
 
     def reset_test(self):
-        self.randoms["val"] = np.random.RandomState(1482)
-        self.randoms["test"] = np.random.RandomState(9424)
+        self.randoms["val"] = np.random.RandomState(FOLD_SEEDS["val"])
+        self.randoms["test"] = np.random.RandomState(FOLD_SEEDS["test"])
+
+    def reseed(self, offset):
+        self.randoms = {
+            fold: np.random.RandomState((seed, offset))
+            for fold, seed in FOLD_SEEDS.items()
+        }
+
+    # states as a dict of arrays, for snapshots; l_msg is stored separately
+    # by the caller since it lives in the episode arrays anyway
+    def pack_states(self, states):
+        batch = DriveBatch.from_states(self.roads, states)
+        return {
+            "map_ids": batch.map_ids,
+            "pos": batch.pos,
+            "dirs": batch.dirs,
+            "goals": batch.goals,
+            "done": batch.done
+        }
+
+    def unpack_states(self, arrays, l_msg):
+        states = DriveBatch(self.roads, **arrays).states()
+        for state, state_l_msg in zip(states, l_msg):
+            state.l_msg = list(np.asarray(state_l_msg, dtype=np.float64))
+        return states
 
     def load_traces(self):
+        cache_path = os.path.join(
+                TRACE_CACHE_DIR, "%s.npz" % _trace_dir_hash(TRACE_DIR))
+        if os.path.exists(cache_path):
+            traces = self._load_trace_cache(cache_path)
+        else:
+            traces = self._parse_traces()
+            self._save_trace_cache(cache_path, traces)
+        train_traces = traces[:-100]
+        test_traces = traces[-100:]
+        return train_traces, test_traces
+
+    def _parse_traces(self):
         traces = []
 
         ngrams = defaultdict(lambda: 0)
@@ -127,12 +198,14 @@ class DriveTask(object):
                     .replace("?", "")
                     .split())
 
-        for filename in os.listdir("data/drive/server_logs"):
+        logs = []
+        for filename in os.listdir(TRACE_DIR):
             if not filename.endswith("json"):
                 continue
-            with open("data/drive/server_logs/" + filename) as trace_f:
-                data = json.load(trace_f)
+            with open(os.path.join(TRACE_DIR, filename)) as trace_f:
+                logs.append(json.load(trace_f))
 
+        for data in logs:
             inputs = data[1::2]
             for inp1, inp2 in inputs:
                 t1, t2 = tokenize(inp1["message"]), tokenize(inp2["message"])
@@ -163,24 +236,20 @@ class DriveTask(object):
 
         assert len(self.lexicon) == N_LEX, str(len(self.lexicon))
 
-        def make_rep(tokens):
-            rep = np.zeros(len(self.lexicon))
-            for i_l, l in enumerate(self.lexicon):
-                if len(l) > 0 and all(self.reverse_vocab[w] in tokens for w in l):
-                    rep[i_l] = 1
-            if not rep.any():
-                rep[0] = 1
-            rep /= np.sum(rep)
-            return rep
-
-        for filename in os.listdir("data/drive/server_logs"):
-            if not filename.endswith("json"):
-                continue
-            with open("data/drive/server_logs/" + filename) as trace_f:
-                data = json.load(trace_f)
+        # every message of every log encoded at once, in order; messages
+        # without any lexicon entry get the empty one
+        matcher = LexiconMatcher(self.lexicon, self.reverse_vocab)
+        reps = matcher.reps([
+                tokenize(inp["message"])
+                for data in logs for pair in data[1::2] for inp in pair])
+        reps[~reps.any(axis=1), 0] = 1
 
+        i_rep = 0
+        for data in logs:
             init = data[0]
             inputs = data[1::2]
+            log_reps = reps[i_rep:i_rep+2*len(inputs)]
+            i_rep += 2 * len(inputs)
 
             road = np.zeros(MAP_SHAPE)
             for r in range(MAP_SHAPE[0]):
@@ -200,11 +269,9 @@ class DriveTask(object):
 
             state = DriveState(map_id, road, cars)
             episode = []
-            for inp1, inp2 in inputs:
+            for t, (inp1, inp2) in enumerate(inputs):
                 action = (inp1["action"], inp2["action"])
-                d1 = tokenize(inp1["message"])
-                d2 = tokenize(inp2["message"])
-                r1, r2 = make_rep(d1), make_rep(d2)
+                r1, r2 = log_reps[2*t], log_reps[2*t+1]
                 desc = (r2, r1)
                 #r1 = [0, 1] if state.cars[1].done else [1, 0]
                 #r2 = [0, 1] if state.cars[0].done else [1, 0]
@@ -215,11 +282,74 @@ class DriveTask(object):
                     state, None, action, state_, None, reward, done))
                 state = state_
 
-            traces.append(episode)
+            traces.append(Episode(episode))
+
+        return traces
+
+    # Columnar layout: every episode of T steps contributes T + 1 rows to the
+    # state arrays and T rows to the per-step arrays.
+    def _save_trace_cache(self, path, traces):
+        states = [s for ep in traces for s in [ep[0].s1] + [e.s2 for e in ep]]
+        batch = DriveBatch.from_states(self.roads, states)
+        words = [self.reverse_vocab[i] for i in range(len(self.vocab))]
+        if not os.path.exists(TRACE_CACHE_DIR):
+            os.makedirs(TRACE_CACHE_DIR)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as cache_f:
+            np.savez(
+                    cache_f,
+                    words=np.asarray(words, dtype=np.unicode_),
+                    lexicon=np.asarray(
+                        [w for l in self.lexicon for w in l], dtype=np.int32),
+                    lexicon_lengths=np.asarray(
+                        [len(l) for l in self.lexicon], dtype=np.int32),
+                    lengths=np.asarray(
+                        [len(ep) for ep in traces], dtype=np.int32),
+                    map_ids=batch.map_ids, pos=batch.pos, dirs=batch.dirs,
+                    goals=batch.goals, done=batch.done,
+                    actions=np.asarray(
+                        [e.a for ep in traces for e in ep], dtype=np.int32),
+                    rewards=np.asarray([e.r for ep in traces for e in ep]),
+                    stops=np.asarray(
+                        [e.t for ep in traces for e in ep], dtype=bool),
+                    l_msg=np.asarray(
+                        [e.s2.l_msg for ep in traces for e in ep]))
+        os.rename(tmp_path, path)
+
+    def _load_trace_cache(self, path):
+        data = np.load(path)
+        words = [unicode(w) for w in data["words"]]
+        self.vocab = {w: i for i, w in enumerate(words)}
+        self.reverse_vocab = dict(enumerate(words))
+        bounds = np.cumsum(np.concatenate(([0], data["lexicon_lengths"])))
+        lexicon = data["lexicon"].tolist()
+        self.lexicon = [
+                lexicon[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        assert len(self.lexicon) == N_LEX, str(len(self.lexicon))
 
-        train_traces = traces[:-100]
-        test_traces = traces[-100:]
-        return train_traces, test_traces
+        states = DriveBatch(
+                self.roads, data["map_ids"], data["pos"], data["dirs"],
+                data["goals"], data["done"]).states()
+        actions = [tuple(a) for a in data["actions"].tolist()]
+        rewards = data["rewards"].tolist()
+        stops = data["stops"].tolist()
+        l_msg = data["l_msg"]
+        traces = []
+        step = 0
+        for i_ep, length in enumerate(data["lengths"].tolist()):
+            # one more state than steps per episode
+            first_state = step + i_ep
+            episode = []
+            for t in range(length):
+                state = states[first_state + t]
+                state_ = states[first_state + t + 1]
+                state_.l_msg = tuple(l_msg[step])
+                episode.append(Experience(
+                    state, None, actions[step], state_, None, rewards[step],
+                    stops[step]))
+                step += 1
+            traces.append(Episode(episode))
+        return traces
 
     def get_demonstration(self, fold):
         if fold in ("train", "val"):
@@ -234,51 +364,104 @@ class DriveTask(object):
         return demos[i]
 
     def get_instance(self, fold, map_id=None):
-        random = self.randoms[fold]
+        randint = self.randoms[fold].randint
         if map_id is None:
-            map_id = random.randint(len(MAPS))
-        map_str = MAPS[map_id]
-        template = map_str.split("\n")[1:-1]
-        start_indices = [
-                (r, c) for r in range(MAP_SHAPE[0]) for c in range(MAP_SHAPE[1])
-                if template[r][c] in ("n", "e", "s", "w")]
-        goal_indices = [
-                (r, c) for r in range(MAP_SHAPE[0]) for c in range(MAP_SHAPE[1])
-                if template[r][c] == "*"]
-
-        agent1_start = start_indices[random.randint(len(start_indices))]
-        agent1_dir = DIRS[template[agent1_start[0]][agent1_start[1]]]
-        start_indices.remove(agent1_start)
-        agent2_start = start_indices[random.randint(len(start_indices))]
-        agent2_dir = DIRS[template[agent2_start[0]][agent2_start[1]]]
-        agent1_goal = goal_indices[random.randint(len(goal_indices))]
-        agent2_goal = goal_indices[random.randint(len(goal_indices))]
-
-        cars = [Car(agent1_start, agent1_dir, agent1_goal, False),
-                Car(agent2_start, agent2_dir, agent2_goal, False)]
-
+            map_id = randint(len(MAPS))
+        template = TEMPLATES[map_id]
+        starts, goals = _draw_cars(randint, template)
+        cars = [Car(template.starts[i_start], template.start_dirs[i_start],
+                    template.goals[i_goal], False)
+                for i_start, i_goal in zip(starts, goals)]
         return DriveState(map_id, self.roads[map_id], cars)
 
+    # the same instances as n calls to get_instance(fold), as a DriveBatch
+    def get_instances(self, fold, n):
+        draws = _RandintReplay(self.randoms[fold], 8 * n)
+        map_ids = np.zeros(n, dtype=np.int64)
+        starts = np.zeros((n, 2), dtype=np.int64)
+        goals = np.zeros((n, 2), dtype=np.int64)
+        for i in range(n):
+            map_ids[i] = draws.randint(len(MAPS))
+            starts[i], goals[i] = _draw_cars(
+                    draws.randint, TEMPLATES[map_ids[i]])
+        draws.close()
+        return DriveBatch(
+                self.roads, map_ids,
+                START_CELLS[map_ids[:, np.newaxis], starts],
+                START_DIRS[map_ids[:, np.newaxis], starts],
+                GOAL_CELLS[map_ids[:, np.newaxis], goals],
+                np.zeros((n, 2), dtype=bool))
+
+    def get_batch(self, fold, n):
+        return self.get_instances(fold, n)
+
+    # a DriveBatch starting from the given states, e.g. demonstration starts
+    def batch_from_states(self, states):
+        return DriveBatch.from_states(self.roads, states)
+
     def distractors_for(self, state, obs_agent, n_samples):
+        batch = self._distractor_batch([state], obs_agent, n_samples)
+        return [(dis, 1) for dis in batch.states()]
+
+    # n_samples distractors per state as one DriveBatch, grouped by state:
+    # obs_agent's car is kept and every other car gets a uniform road cell,
+    # heading and goal on the same map
+    def _distractor_batch(self, states, obs_agent, n_samples):
         random = self.randoms["val"]
-        out = []
-        for _ in range(n_samples):
-            pos = None
-            while pos is None:
-                pos = (random.randint(MAP_SHAPE[0]),
-                            random.randint(MAP_SHAPE[1]))
-                if not state.road[pos]:
-                    pos = None
-            inst = self.get_instance("val", state.map_id)
-            cars = []
-            for i_car, car in enumerate(state.cars):
-                if i_car == obs_agent:
-                    cars.append(state.cars[i_car])
-                else:
-                    cars.append(inst.cars[i_car]._replace(pos=pos, dir=random.randint(4)))
-            out.append((DriveState(state.map_id, state.road, cars), 1))
+        map_ids = np.repeat([s.map_id for s in states], n_samples)
+        shape = (len(map_ids), self.n_agents)
+        i_cells = (random.rand(*shape)
+                * N_ROAD_CELLS[map_ids, np.newaxis]).astype(np.int64)
+        i_goals = (random.rand(*shape)
+                * N_GOAL_CELLS[map_ids, np.newaxis]).astype(np.int64)
+        pos = ROAD_CELLS[map_ids[:, np.newaxis], i_cells]
+        dirs = random.randint(4, size=shape)
+        goals = GOAL_CELLS[map_ids[:, np.newaxis], i_goals]
+        done = np.zeros(shape, dtype=bool)
+
+        kept = [s.cars[obs_agent] for s in states]
+        pos[:, obs_agent] = np.repeat([c.pos for c in kept], n_samples, axis=0)
+        dirs[:, obs_agent] = np.repeat([c.dir for c in kept], n_samples)
+        goals[:, obs_agent] = np.repeat(
+                [c.goal for c in kept], n_samples, axis=0)
+        done[:, obs_agent] = np.repeat([c.done for c in kept], n_samples)
+        return DriveBatch(self.roads, map_ids, pos, dirs, goals, done)
+
+    def distractor_obs(self, states, obs_agent, n_samples):
+        out = np.zeros(
+                (len(states), n_samples, self.n_agents, N_FEATURES),
+                dtype=np.float32)
+        missing = OrderedDict()
+        for i, state in enumerate(states):
+            key = (state.key(), obs_agent, n_samples)
+            if key in self.distractor_cache:
+                # refresh the entry so that eviction is least-recently-used
+                obs = self.distractor_cache.pop(key)
+                self.distractor_cache[key] = obs
+                out[i] = obs
+            elif key in missing:
+                missing[key].append(i)
+            else:
+                missing[key] = [i]
+
+        if len(missing) == 0:
+            return out
+
+        new_obs = self._make_distractor_obs(
+                [states[indices[0]] for indices in missing.values()],
+                obs_agent, n_samples)
+        for (key, indices), obs in zip(missing.items(), new_obs):
+            out[indices] = obs
+            if len(self.distractor_cache) >= DISTRACTOR_CACHE_SIZE:
+                self.distractor_cache.popitem(last=False)
+            self.distractor_cache[key] = obs.copy()
         return out
 
+    def _make_distractor_obs(self, states, obs_agent, n_samples):
+        obs = self._distractor_batch(states, obs_agent, n_samples).obs()
+        return np.stack(obs, axis=1).reshape(
+                (len(states), n_samples, self.n_agents, N_FEATURES))
+
     def visualize(self, state, agent):
         draw = [[None for _ in range(MAP_SHAPE[1])] for _ in range(MAP_SHAPE[0])]
         car = state.cars[agent]
@@ -322,6 +505,9 @@ class DriveState(object):
         self._cached_obs = None
         self.success = all(c.done for c in cars)
 
+    def key(self):
+        return (self.map_id, tuple(self.cars))
+
     def obs(self):
         if self._cached_obs is None:
             self._cached_obs =  tuple(self._obs(car) for car in self.cars)
@@ -349,43 +535,31 @@ class DriveState(object):
                     #pos, goal,
                     direction))
 
+    def obs_indices(self):
+        index = np.zeros((len(self.cars), N_OBS_INDICES), dtype=np.int32)
+        value = np.zeros((len(self.cars), N_OBS_INDICES), dtype=np.float32)
+        for i_car, car in enumerate(self.cars):
+            if car.done:
+                continue
+            index[i_car] = (
+                    self.map_id,
+                    POS_OFFSET + car.pos[0] * MAP_SHAPE[1] + car.pos[1],
+                    GOAL_OFFSET + car.goal[0] * MAP_SHAPE[1] + car.goal[1],
+                    DIR_OFFSET + car.dir)
+            value[i_car] = 1
+        return index, value
+
+    # any action but waiting moves one cell along the (new) heading
     def _move(self, car, action):
+        ndir = (car.dir + ACTION_TURN_STEPS[action]) % 4
         nr, nc = car.pos
-        ndir = car.dir
-        turn = False
-        if action == 0:
-            pass
-        elif action == 1:
-            if car.dir == 0:
-                nr -= 1
-            elif car.dir == 1:
-                nc += 1
-            elif car.dir == 2:
-                nr += 1
-            elif car.dir == 3:
-                nc -= 1
-        elif action == 2:
-            ndir -= 1
-            turn = True
-        elif action == 3:
-            ndir += 1
-            turn = True
-        ndir %= 4
-
-        if turn:
-            if ndir == 0:
-                nr -= 1
-            elif ndir == 1:
-                nc += 1
-            elif ndir == 2:
-                nr += 1
-            elif ndir == 3:
-                nc -= 1
-
-        nr = min(nr, self.road.shape[0]-1)
-        nc = min(nc, self.road.shape[1]-1)
-        nr = max(nr, 0)
-        nc = max(nc, 0)
+        if action != 0:
+            dr, dc = HEADING_STEPS[ndir]
+            nr += dr
+            nc += dc
+
+        nr = min(max(nr, 0), self.road.shape[0]-1)
+        nc = min(max(nc, 0), self.road.shape[1]-1)
 
         if car.done:
             nr, nc = -1, -1
@@ -395,44 +569,22 @@ class DriveState(object):
     def step(self, actions):
         assert len(actions) == len(self.cars)
         ncars = [self._move(c, a) for c, a in zip(self.cars, actions)]
-        occupied = np.zeros(self.road.shape)
-        heads = np.zeros(self.road.shape)
-        tails = np.zeros(self.road.shape)
+        # each live car covers its head cell and, if it is on the grid, the
+        # tail cell behind it
+        cells = []
         for car in ncars:
             if car.done:
                 continue
-            pos = car.pos
-            r2, c2 = car.pos
-            if car.dir == 0:
-                r2 += 1
-            elif car.dir == 1:
-                c2 -= 1
-            elif car.dir == 2:
-                r2 -= 1
-            elif car.dir == 3:
-                c2 += 1
-            occupied[pos] += 1
-            heads[pos] += 1
+            r, c = car.pos
+            cells.append((r, c))
+            dr, dc = HEADING_STEPS[car.dir]
+            r2, c2 = r - dr, c - dc
             if 0 <= r2 < self.road.shape[0] and 0 <= c2 < self.road.shape[1]:
-                occupied[r2, c2] += 1
-                tails[r2, c2] += 1
+                cells.append((r2, c2))
 
-        off = 0
-        crash = False
-        draw = [[None for _ in range(MAP_SHAPE[1])] for _ in range(MAP_SHAPE[0])]
-        for r in range(self.road.shape[0]):
-            for c in range(self.road.shape[1]):
-                draw[r][c] = "." if self.road[r][c] else " "
-                for car in ncars:
-                    draw[car.goal[0]][car.goal[1]] = "G"
-                if heads[r, c] > 0:
-                    draw[r][c] = "#"
-                if tails[r, c] > 0:
-                    draw[r][c] = "O"
-                if occupied[r, c] > 0 and self.road[r, c] == 0:
-                    off += 1
-                if occupied[r, c] > 1:
-                    crash = True
+        covered = set(cells)
+        crash = len(covered) < len(cells)
+        off = sum(1 for cell in covered if self.road[cell] == 0)
 
         #reverse = len([a for a in actions if a == 1])
 
@@ -465,8 +617,203 @@ class DriveState(object):
         reward += 1.0 * n_success
         reward += 0.1 * n_improved
 
-        #print "\n".join(["".join(row) for row in draw])
-        #print reward
-        #print
-
         return DriveState(self.map_id, self.road, final_cars), reward, stop
+
+DIR_DELTAS = np.asarray(HEADING_STEPS)
+ACTION_TURNS = np.asarray(ACTION_TURN_STEPS)
+
+# start and goal indices for both cars, with the draws get_instance makes
+def _draw_cars(randint, template):
+    n_starts = len(template.starts)
+    start1 = randint(n_starts)
+    # the second car starts anywhere but the first car's cell
+    start2 = randint(n_starts - 1)
+    start2 += start2 >= start1
+    goal1 = randint(len(template.goals))
+    goal2 = randint(len(template.goals))
+    return (start1, start2), (goal1, goal2)
+
+# the templates padded into (maps, cells, ...) tables for batched lookups
+def _template_table(field):
+    n_cells = max(len(getattr(t, field)) for t in TEMPLATES)
+    table = []
+    for template in TEMPLATES:
+        cells = list(getattr(template, field))
+        table.append(cells + [cells[-1]] * (n_cells - len(cells)))
+    return np.asarray(table, dtype=np.int64)
+
+START_CELLS = _template_table("starts")
+START_DIRS = _template_table("start_dirs")
+GOAL_CELLS = _template_table("goals")
+ROAD_CELLS = _template_table("road_cells")
+N_GOAL_CELLS = np.asarray([len(t.goals) for t in TEMPLATES])
+N_ROAD_CELLS = np.asarray([len(t.road_cells) for t in TEMPLATES])
+
+class _RandintReplay(object):
+    # Replays a sequence of random.randint(high) calls from raw 32-bit words
+    # drawn in bulk. numpy masks each word to the smallest all-ones bit mask
+    # covering high - 1, rejects values >= high and draws nothing when high
+    # is 1; close() leaves random as if only the used words had been drawn.
+    def __init__(self, random, n_words):
+        self.random = random
+        self.state = random.get_state()
+        self.words = []
+        self.n_words = n_words
+        self.used = 0
+
+    def randint(self, high):
+        if high == 1:
+            return 0
+        mask = (1 << int(high - 1).bit_length()) - 1
+        while True:
+            if self.used == len(self.words):
+                self.words += self.random.randint(
+                        1 << 32, size=self.n_words, dtype=np.uint32).tolist()
+            value = self.words[self.used] & mask
+            self.used += 1
+            if value < high:
+                return value
+
+    def close(self):
+        self.random.set_state(self.state)
+        self.random.randint(1 << 32, size=self.used, dtype=np.uint32)
+
+# changes whenever a log is added, removed or rewritten
+def _trace_dir_hash(directory):
+    digest = hashlib.sha1(str(TRACE_CACHE_VERSION))
+    for filename in sorted(os.listdir(directory)):
+        stat = os.stat(os.path.join(directory, filename))
+        digest.update("%s %d %d\n" % (filename, stat.st_size, stat.st_mtime))
+    return digest.hexdigest()
+
+class DriveBatch(object):
+    # N worlds stored as arrays: map_ids (N,), pos and goals (N, cars, 2),
+    # dirs and done (N, cars). step() reproduces DriveState.step for every
+    # world at once.
+    def __init__(self, roads, map_ids, pos, dirs, goals, done):
+        self.roads = roads
+        self.road_grid = np.asarray(roads)
+        self.map_ids = map_ids
+        self.pos = pos
+        self.dirs = dirs
+        self.goals = goals
+        self.done = done
+        n_worlds, n_cars = done.shape
+        self.l_msg = tuple(np.zeros((n_worlds, N_LEX)) for _ in range(n_cars))
+
+    @classmethod
+    def from_states(cls, roads, states):
+        return cls(
+                roads,
+                np.asarray([s.map_id for s in states]),
+                np.asarray([[c.pos for c in s.cars] for s in states]),
+                np.asarray([[c.dir for c in s.cars] for s in states]),
+                np.asarray([[c.goal for c in s.cars] for s in states]),
+                np.asarray([[c.done for c in s.cars] for s in states]))
+
+    def __len__(self):
+        return len(self.map_ids)
+
+    # the arrays step() changes, for keeping a copy of the batch in sync
+    def get_step_state(self):
+        return self.pos, self.dirs, self.done
+
+    def set_step_state(self, step_state):
+        self.pos, self.dirs, self.done = step_state
+
+    def states(self):
+        obs = self.obs()
+        out = []
+        for i, (map_id, pos, dirs, goals, done) in enumerate(zip(
+                self.map_ids.tolist(), self.pos.tolist(), self.dirs.tolist(),
+                self.goals.tolist(), self.done.tolist())):
+            cars = [Car(tuple(p), d, tuple(g), n)
+                    for p, d, g, n in zip(pos, dirs, goals, done)]
+            state = DriveState(map_id, self.roads[map_id], cars)
+            state._cached_obs = tuple(o[i] for o in obs)
+            out.append(state)
+        return out
+
+    def obs(self):
+        index, value = self.obs_indices()
+        n_worlds, n_cars, _ = index.shape
+        features = np.zeros((n_worlds, n_cars, N_FEATURES), dtype=np.float32)
+        features[
+                np.arange(n_worlds)[:, np.newaxis, np.newaxis],
+                np.arange(n_cars)[np.newaxis, :, np.newaxis],
+                index] = value
+        return tuple(features[:, i_car] for i_car in range(n_cars))
+
+    # (N, cars, N_OBS_INDICES) feature indices and values; done cars get all
+    # zero values, matching their all-zero dense observation
+    def obs_indices(self):
+        n_worlds, n_cars = self.done.shape
+        index = np.empty((n_worlds, n_cars, N_OBS_INDICES), dtype=np.int32)
+        index[:, :, 0] = self.map_ids[:, np.newaxis]
+        index[:, :, 1] = (
+                POS_OFFSET + self.pos[..., 0] * MAP_SHAPE[1] + self.pos[..., 1])
+        index[:, :, 2] = (
+                GOAL_OFFSET + self.goals[..., 0] * MAP_SHAPE[1]
+                + self.goals[..., 1])
+        index[:, :, 3] = DIR_OFFSET + self.dirs
+        index[self.done] = 0
+        value = np.zeros((n_worlds, n_cars, N_OBS_INDICES), dtype=np.float32)
+        value[~self.done] = 1
+        return index, value
+
+    def step(self, actions, active=None):
+        actions = np.asarray(actions)
+        n_worlds, n_cars = self.done.shape
+        if active is None:
+            active = np.ones(n_worlds, dtype=bool)
+
+        # move
+        dirs = (self.dirs + ACTION_TURNS[actions]) % 4
+        moved = (actions != 0)[:, :, np.newaxis]
+        pos = np.clip(
+                self.pos + moved * DIR_DELTAS[dirs], 0, np.asarray(MAP_SHAPE) - 1)
+        pos[self.done] = -1
+
+        # every live car covers its head cell and, if on the map, its tail
+        tails = pos - DIR_DELTAS[dirs]
+        tail_ok = np.all((tails >= 0) & (tails < np.asarray(MAP_SHAPE)), axis=2)
+        live = ~self.done
+        cells = np.concatenate((pos, tails), axis=1)
+        valid = np.concatenate((live, live & tail_ok), axis=1)
+        cell_ids = np.where(
+                valid, cells[:, :, 0] * MAP_SHAPE[1] + cells[:, :, 1], -1)
+
+        same = (cell_ids[:, :, np.newaxis] == cell_ids[:, np.newaxis, :]) \
+                & valid[:, :, np.newaxis] & valid[:, np.newaxis, :]
+        earlier = np.tril(np.ones((2 * n_cars, 2 * n_cars), dtype=bool), -1)
+        crash = np.any(same & earlier, axis=(1, 2))
+        first = valid & ~np.any(same & earlier, axis=2)
+        flat_roads = self.road_grid.reshape((len(self.road_grid), -1))
+        on_road = flat_roads[
+                self.map_ids[:, np.newaxis], np.maximum(cell_ids, 0)] != 0
+        off = np.sum(first & ~on_road, axis=1)
+
+        # arrive or make progress
+        at_goal = live & np.all(pos == self.goals, axis=2)
+        old_dist = np.sum(np.abs(self.goals - self.pos), axis=2)
+        new_dist = np.sum(np.abs(self.goals - pos), axis=2)
+        improving = live & ~at_goal
+        n_success = np.sum(at_goal, axis=1)
+        n_improved = np.sum(np.where(improving, old_dist - new_dist, 0), axis=1)
+        done = self.done | at_goal
+
+        # accumulated in the same order as DriveState.step so that rewards
+        # match to the last bit
+        reward = np.zeros(n_worlds)
+        reward = np.where(crash, reward - 2.0, reward)
+        reward -= 0.01
+        reward -= 0.5 * off
+        reward += 1.0 * n_success
+        reward += 0.1 * n_improved
+        stop = np.all(done, axis=1) | crash
+
+        mask = active[:, np.newaxis]
+        self.pos = np.where(mask[:, :, np.newaxis], pos, self.pos)
+        self.dirs = np.where(mask, dirs, self.dirs)
+        self.done = np.where(mask, done, self.done)
+        return np.where(active, reward, 0.), stop & active
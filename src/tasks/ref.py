@@ -1,4 +1,4 @@
-from experience import Experience
+from experience import Experience, Episode, StateBatch
 
 import numpy as np
 
@@ -73,6 +73,12 @@ class RefTask(object):
                     distractor, target, 1, desc, self.empty_desc, left_data,
                     right_data, first=True, success=False)
 
+    def reseed(self, offset):
+        self.random = np.random.RandomState((0, offset))
+
+    def get_batch(self, fold, n):
+        return StateBatch([self.get_instance(fold) for _ in range(n)])
+
     def get_demonstration(self, fold):
         state1 = self.get_instance(fold)
         action1 = (0, 2)
@@ -85,7 +91,7 @@ class RefTask(object):
             state1, None, action1, state2, None, r1, False))
         ep.append(Experience(
             state2, None, action2, state3, None, r2, True))
-        return ep
+        return Episode(ep)
 
     def distractors_for(self, state, obs_agent, n_samples):
         out = []
@@ -99,3 +105,9 @@ class RefTask(object):
                     state.right_data, state.first, success=False),
                 0.5))
         return out
+
+    def distractor_obs(self, states, obs_agent, n_samples):
+        return np.asarray([
+                [dis.obs() for dis, _ in
+                    self.distractors_for(state, obs_agent, n_samples)]
+                for state in states])
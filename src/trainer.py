@@ -1,22 +1,44 @@
-from experience import Experience
+from experience import Experience, Episode, RolloutStep
+from prefetch import Prefetcher
+from replay import ReplayMemory, PrioritizedReplayMemory
+import snapshot
 
+import functools
 import logging
 import numpy as np
 import os
 import tensorflow as tf
 
 random = np.random.RandomState(5828)
+# batch sampling has its own stream, so that prefetching can't reorder its
+# draws against exploration
+batch_random = np.random.RandomState(3417)
 
 #@profile
+# workers, if given, are RolloutWorkers started before the session
 def run(task, rollout_ph, replay_ph, reconst_ph, model, desc_model, translator,
-        session, config):
+        session, config, workers=None):
     saver = tf.train.Saver()
-    replay = []
-    good_replay = []
+    if config.trainer.prioritized:
+        replay = PrioritizedReplayMemory(
+                config.trainer.n_replay_episodes, config.trainer.priority_alpha,
+                config.trainer.priority_beta)
+    else:
+        replay = ReplayMemory(config.trainer.n_replay_episodes)
     demonstrations = []
 
+    start_iter = 0
     if config.trainer.resume:
         load(session, config)
+        snapshot_dir = "experiments/%s/snapshot" % config.model.load
+        if os.path.exists(snapshot_dir):
+            extra = snapshot.load(snapshot_dir, task, replay, demonstrations)
+            start_iter = extra["i_iter"]
+            random.set_state(extra["random"])
+            batch_random.set_state(extra["batch_random"])
+            if workers is not None:
+                workers.set_randoms(extra.get("worker_randoms"))
+            logging.info("[resume] \t%d", start_iter)
     else:
         session.run(tf.global_variables_initializer())
 
@@ -25,16 +47,33 @@ def run(task, rollout_ph, replay_ph, reconst_ph, model, desc_model, translator,
     h0, z0, _ = session.run(
             model.zero_state(config.trainer.n_rollout_episodes, tf.float32))
     max_iters = max(config.trainer.n_iters, config.trainer.n_desc_iters)
-    for i_iter in range(max_iters):
+    sample_batch = functools.partial(
+            _sample_batch, replay, demonstrations, config)
+    build_batch = functools.partial(
+            _build_batch, task, replay_ph, reconst_ph, config)
+    n_prefetch = config.trainer.n_prefetch
+    prefetcher = None
+    if n_prefetch > 0:
+        prefetcher = Prefetcher(build_batch, n_prefetch)
+    for i_iter in range(start_iter, max_iters):
         score = _do_rollout(
-                task, rollout_ph, model, desc_model, replay, good_replay,
-                session, config, i_iter, h0, z0)
+                task, rollout_ph, model, desc_model, replay, session, config,
+                i_iter, h0, z0, workers=workers)
         demonstrations.append(task.get_demonstration("train"))
-        loss = _do_step(
-                task, replay_ph, reconst_ph, model, desc_model, translator,
-                replay, good_replay, demonstrations, session, config,
-                i_iter < config.trainer.n_iters,
-                i_iter < config.trainer.n_desc_iters)
+        if prefetcher is None:
+            batch = build_batch(sample_batch(i_iter))
+        else:
+            # batches for the next n_prefetch iterations are sampled now,
+            # before the rollouts and priority updates those iterations add,
+            # and built while they run
+            if prefetcher.n_pending == 0:
+                prefetcher.put(sample_batch(i_iter))
+            batch = prefetcher.get()
+            i_next = i_iter + 1 + prefetcher.n_pending
+            while prefetcher.n_pending < n_prefetch and i_next < max_iters:
+                prefetcher.put(sample_batch(i_next))
+                i_next += 1
+        loss = _do_step(batch, model, desc_model, translator, replay, session)
         total_score += np.asarray(score)
         total_loss += np.asarray(loss)
 
@@ -67,6 +106,12 @@ def run(task, rollout_ph, replay_ph, reconst_ph, model, desc_model, translator,
                 import lexicographer
                 import evaluator
                 import calibrator
+                # evaluation shares the task RNGs and distractor cache with
+                # batch construction, so stop prefetching while it runs; the
+                # batches sampled ahead are dropped and sampled afresh, as
+                # they are after resuming from the snapshot below
+                if prefetcher is not None:
+                    prefetcher.close()
                 lex = lexicographer.run(
                         task, rollout_ph, reconst_ph, model, desc_model,
                         translator, session, config)
@@ -76,126 +121,181 @@ def run(task, rollout_ph, replay_ph, reconst_ph, model, desc_model, translator,
                 evaluator.run(
                         task, rollout_ph, replay_ph, reconst_ph, model,
                         desc_model, lex, session, config, "val")
+                # after evaluation, which also draws from the RNGs
+                if config.trainer.snapshot:
+                    snapshot.save(
+                            config.experiment_dir + "/snapshot", task, replay,
+                            demonstrations,
+                            {"i_iter": i_iter + 1, "random": random.get_state(),
+                                "batch_random": batch_random.get_state(),
+                                "worker_randoms": (
+                                    workers.get_randoms() if workers else None)})
+                if prefetcher is not None:
+                    prefetcher = Prefetcher(build_batch, n_prefetch)
+
+    if prefetcher is not None:
+        prefetcher.close()
 
 def load(session, config):
     saver = tf.train.Saver()
     saver.restore(session, "experiments/%s/model" % config.model.load)
 
+# where the weights in use were saved: by this run when training, otherwise
+# by the run being loaded
+def checkpoint_dir(config):
+    if config.task.train:
+        return config.experiment_dir
+    return "experiments/%s" % config.model.load
+
 #@profile
 def _do_rollout(
-        task, rollout_ph, model, desc_model, replay, good_replay, session,
-        config, i_iter, h0, z0, fold="train", use_desc=False):
-    worlds = [task.get_instance(fold) for _ in range(config.trainer.n_rollout_episodes)]
-    done = [False] * config.trainer.n_rollout_episodes
-    episodes = [[] for i in range(config.trainer.n_rollout_episodes)]
+        task, rollout_ph, model, desc_model, replay, session, config, i_iter,
+        h0, z0, fold="train", use_desc=False, workers=None, n_episodes=None,
+        randoms=None):
+    n_episodes = n_episodes or config.trainer.n_rollout_episodes
+    step = RolloutStep(rollout_ph, model, desc_model, session, task, config)
+    worlds = (workers or task).get_batch(fold, n_episodes)
+    states = worlds.states()
+    done = np.zeros(n_episodes, dtype=bool)
+    episodes = [[] for i in range(n_episodes)]
     hs, zs, dhs = h0, z0, h0
     for t in range(config.trainer.n_timeout):
-        hs_, zs_, qs, dhs_, dqs = session.run(
-                [model.tt_rollout_h, model.tt_rollout_z, model.tt_rollout_q,
-                    desc_model.tt_rollout_h, desc_model.tt_rollout_q],
-                rollout_ph.feed(hs, zs, dhs, worlds, task, config))
+        # desc_model only runs when it acts; otherwise its memory stays at h0
+        if use_desc:
+            hs_, zs_, dhs_, used_qs = step(
+                    ("h", "z", "l_h", "l_q"), hs, zs, dhs, worlds, randoms)
+        else:
+            hs_, zs_, used_qs = step(
+                    ("h", "z", "q"), hs, zs, dhs, worlds, randoms)
+            dhs_ = dhs
         eps = max(
                 (1000. - i_iter) / 1000., 
                 #0.1 * (10000. - i_iter) / 10000.,
                 0.1 * (5000. - i_iter) / 5000.,
                 #0.01)
                 0)
-        for i in range(config.trainer.n_rollout_episodes):
-            if done[i]:
-                continue
-            actions = []
-            used_qs = qs
-            if use_desc:
-                used_qs = dqs
-            for q in used_qs:
-                q = q[i, :]
-                # TODO configurable
-                if random.rand() < eps:
-                    a = random.randint(len(q))
-                else:
-                    a = np.argmax(q)
-                actions.append(a)
+        actions = np.zeros((n_episodes, len(used_qs)), dtype=np.int64)
+        for i_agent, q in enumerate(used_qs):
+            # TODO configurable
+            explore = random.rand(n_episodes) < eps
+            actions[:, i_agent] = np.argmax(q, axis=1)
+            actions[explore, i_agent] = random.randint(
+                    q.shape[1], size=np.sum(explore))
 
+        active = ~done
+        rewards, stops = worlds.step(actions, active)
+        if t == config.trainer.n_timeout - 1:
+            stops = active
+        states_ = worlds.states()
+        for i in np.flatnonzero(active):
             h = [oh[i] for oh in hs]
             z = [oz[i] for oz in zs]
             h_ = [oh_[i] for oh_ in hs_]
             z_ = [oz_[i] for oz_ in zs_]
             dh = [odh[i] for odh in dhs]
             dh_ = [odh_[i] for odh_ in dhs_]
-            world_, reward, done_ = worlds[i].step(actions)
-            done_ = done_ or t == config.trainer.n_timeout - 1
             episodes[i].append(Experience(
-                worlds[i], (h, z, dh), tuple(actions), world_, (h_, z_, dh_),
-                reward, done_))
-            worlds[i] = world_
-            done[i] = done_
+                states[i], (h, z, dh), tuple(actions[i].tolist()), states_[i],
+                (h_, z_, dh_), rewards[i], bool(stops[i])))
+        done |= stops
+        states = states_
 
         hs = hs_
         zs = zs_
         dhs = dhs_
 
-        if all(done):
+        if done.all():
             break
 
-    replay += episodes
-    for episode in episodes:
-        if any(e.r > 0 for e in episode):
-            good_replay.append(episode)
+    episodes = [Episode(episode) for episode in episodes]
+    replay.extend(episodes)
+    return (sum(e.r for ep in episodes for e in ep) * 1. / n_episodes,
+            sum(ep[-1].s2.success for ep in episodes) * 1. / n_episodes)
 
-    del replay[:-config.trainer.n_replay_episodes]
-    del good_replay[:-config.trainer.n_replay_episodes]
-    return (sum(e.r for ep in episodes for e in ep) * 1. / 
-                config.trainer.n_rollout_episodes, 
-            sum(ep[-1].s2.success for ep in episodes) * 1. /
-                config.trainer.n_rollout_episodes)
-
-#@profile
-def _do_step(
-        task, replay_ph, reconst_ph, model, desc_model, translator, replay,
-        good_replay, demonstrations, session, config, update_model, update_desc):
+# Everything random about a training batch: which replay and demonstration
+# slices it uses, their weights and the experiences the translator sees.
+# Runs on the main thread, so the draws and the replay state they see never
+# depend on thread timing.
+def _sample_batch(replay, demonstrations, config, i_iter):
     n_good = int(config.trainer.n_batch_episodes * config.trainer.good_fraction)
     n_any = config.trainer.n_batch_episodes - n_good
-    if (len(replay) < n_any or len(good_replay) < n_good
+    if (len(replay) < n_any or replay.n_good < n_good
             or len(demonstrations) < config.trainer.n_batch_episodes):
-        return [0, 0, 0, 0]
-    episodes = []
+        return None
+    good_indices = replay.sample_good(n_good, batch_random)
+    any_indices = replay.sample(n_any, batch_random)
+    indices = np.concatenate((good_indices, any_indices))
+    weights = np.concatenate((
+            np.ones(n_good), replay.weights(any_indices)))
+    offsets = replay.sample_offsets(
+            indices, config.trainer.n_batch_history, batch_random)
+    slices = [
+            replay[i][o:o+config.trainer.n_batch_history]
+            for i, o in zip(indices, offsets)]
+
     desc_episodes = []
-    for _ in range(n_good):
-        episodes.append(good_replay[random.randint(len(good_replay))])
-    for _ in range(n_any):
-        episodes.append(replay[random.randint(len(replay))])
     for _ in range(config.trainer.n_batch_episodes):
-        demo = demonstrations[random.randint(len(demonstrations))]
-        offset = random.randint(max(1, len(demo)-config.trainer.n_batch_history))
+        demo = demonstrations[batch_random.randint(len(demonstrations))]
+        offset = batch_random.randint(
+                max(1, len(demo)-config.trainer.n_batch_history))
         sl = demo[offset:offset+config.trainer.n_batch_history]
         desc_episodes.append(sl)
 
-    slices = []
-    for ep in episodes:
-        bd = max(1, len(ep)-config.trainer.n_batch_history)
-        offset = random.randint(bd)
-        sl = ep[offset:offset+config.trainer.n_batch_history]
-        slices.append(sl)
+    sample = {
+        "i_iter": i_iter,
+        "indices": indices,
+        "weights": weights,
+        "slices": slices,
+        "desc_episodes": desc_episodes
+    }
+    if i_iter < config.trainer.n_iters:
+        sample["tr_model"] = [
+                e[batch_random.randint(len(e))] for e in slices]
+        sample["tr_desc"] = [
+                e[batch_random.randint(len(e))] for e in desc_episodes]
+    return sample
 
-    model_loss = tr_m_loss = tr_d_loss = 0
-    if update_model:
-        feed = replay_ph.feed(slices, task, config)
-        model_loss, _ = session.run([model.t_loss, model.t_train_op], feed)
+# the feeds for a sampled batch; this is the slow part, which may run on the
+# prefetch thread. Besides the sampled episodes it only uses the task's
+# distractor cache and "val" RNG, which nothing else touches during training.
+#@profile
+def _build_batch(task, replay_ph, reconst_ph, config, sample):
+    if sample is None:
+        return None
+    i_iter = sample["i_iter"]
+    batch = {"indices": sample["indices"]}
+    if i_iter < config.trainer.n_iters:
+        feed = replay_ph.feed(sample["slices"], task, config)
+        feed[replay_ph.t_weight] = sample["weights"]
+        batch["model"] = feed
+        batch["tr_model"] = reconst_ph.feed(
+                sample["tr_model"], 1, 0, task, config)
+        batch["tr_desc"] = reconst_ph.feed(
+                sample["tr_desc"], 1, 0, task, config)
+    if i_iter < config.trainer.n_desc_iters:
+        batch["desc"] = replay_ph.feed(sample["desc_episodes"], task, config)
+    return batch
 
-        tr_m_feed = reconst_ph.feed(
-                [e[random.randint(len(e))] for e in slices], 1, 0, task, config)
+def _do_step(batch, model, desc_model, translator, replay, session):
+    if batch is None:
+        return [0, 0, 0, 0]
+
+    model_loss = tr_m_loss = tr_d_loss = 0
+    if "model" in batch:
+        model_loss, slice_td, _ = session.run(
+                [model.t_loss, model.t_slice_td, model.t_train_op],
+                batch["model"])
+        replay.update_priorities(batch["indices"], slice_td)
         tr_m_loss, _ = session.run(
-                [translator.t_model_loss, translator.t_train_model_op], tr_m_feed)
-        tr_d_feed = reconst_ph.feed(
-                [e[random.randint(len(e))] for e in desc_episodes], 1, 0, task,
-                config)
+                [translator.t_model_loss, translator.t_train_model_op],
+                batch["tr_model"])
         tr_d_loss, _ = session.run(
-                [translator.t_desc_loss, translator.t_train_desc_op], tr_d_feed)
+                [translator.t_desc_loss, translator.t_train_desc_op],
+                batch["tr_desc"])
 
     desc_loss = 0
-    if update_desc:
-        desc_feed = replay_ph.feed(desc_episodes, task, config)
+    if "desc" in batch:
         desc_loss, _ = session.run(
-                [desc_model.t_loss, desc_model.t_train_op], desc_feed)
+                [desc_model.t_loss, desc_model.t_train_op], batch["desc"])
 
     return [model_loss, desc_loss, tr_m_loss, tr_d_loss]
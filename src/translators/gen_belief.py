@@ -2,8 +2,14 @@ import net
 
 import tensorflow as tf
 
+# softmax over the last axis of a tensor of any rank
+def _softmax(t_in, n_last):
+    return tf.reshape(
+            tf.nn.softmax(tf.reshape(t_in, (-1, n_last))), tf.shape(t_in))
+
 class GenBeliefTranslator(object):
     def build(self, task, reconst_ph, channel, model, config):
+        n_choices = config.trainer.n_distractors + 1
         with tf.variable_scope("belief_translator") as scope:
             t_xa_true_rs = tf.reshape(
                     reconst_ph.t_xa_true,
@@ -42,6 +48,21 @@ class GenBeliefTranslator(object):
                     self.t_model_belief = tf.nn.softmax(t_model_raw_belief)
                     #self.t_model_weights = tf.nn.softmax(t_model_logprob)
                     self.t_model_logweights = t_model_logprob
+
+                    # (codes, batch, choices) and (codes, batch) for every
+                    # code in t_z_batch at once
+                    t_z_batch = reconst_ph.t_z_batch
+                    t_model_raw_belief_batch = -tf.reduce_sum(
+                            tf.square(tf.expand_dims(t_all_mean, 0)
+                                - tf.reshape(t_z_batch,
+                                    (-1, 1, 1, config.channel.n_msg))),
+                            axis=3)
+                    self.t_model_belief_batch = _softmax(
+                            t_model_raw_belief_batch, n_choices)
+                    self.t_model_logweights_batch = -tf.reduce_sum(
+                            tf.square(tf.expand_dims(t_mean, 0)
+                                - tf.expand_dims(t_z_batch, 1)),
+                            axis=2)
                 else:
                     assert False
 
@@ -86,6 +107,21 @@ class GenBeliefTranslator(object):
                     self.t_desc_belief = tf.nn.softmax(t_all_scores)
                     #self.t_desc_weights = tf.nn.softmax(t_desc_logprob)
                     self.t_desc_logweights = t_desc_logprob
+
+                    # the cross-entropy against each message in
+                    # t_l_msg_batch is a product with the log-probabilities
+                    n_lex = len(task.lexicon)
+                    t_all_logprob = tf.nn.log_softmax(
+                            tf.reshape(t_all_dist, (-1, n_lex)))
+                    t_all_scores_batch = tf.reshape(
+                            tf.matmul(reconst_ph.t_l_msg_batch, t_all_logprob,
+                                transpose_b=True),
+                            (-1, config.trainer.n_batch_episodes, n_choices))
+                    self.t_desc_belief_batch = _softmax(
+                            t_all_scores_batch, n_choices)
+                    self.t_desc_logweights_batch = tf.matmul(
+                            reconst_ph.t_l_msg_batch,
+                            tf.nn.log_softmax(t_dist), transpose_b=True)
                 else:
                     assert False
 
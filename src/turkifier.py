@@ -1,3 +1,4 @@
+from experience import RolloutStep
 from tasks.ref import RefTask
 
 import numpy as np
@@ -9,9 +10,8 @@ def _sample_ref(
     state = task.get_instance(fold)
     hs, zs = h0, z0
     dhs = h0
-    hs_, zs_, qs = session.run(
-            [model.tt_rollout_h, model.tt_rollout_z, model.tt_rollout_q],
-            rollout_ph.feed(hs, zs, dhs, [state], task, config))
+    step = RolloutStep(rollout_ph, model, None, session, task, config)
+    zs_, = step(("z",), hs, zs, dhs, [state])
     code = zs_[0][0, :]
     l_descs = code_to_desc(code, config.lexicographer.mode)[:5]
     l_ens = [" ".join(task.reverse_vocab[w] for w in d) for d in l_descs]
@@ -1,5 +1,7 @@
 import importlib
+import numpy as np
 import re
+from scipy import sparse
 
 class Break(Exception):
     pass
@@ -71,6 +73,44 @@ class Index:
     def __iter__(self):
         return iter(self.ordered_contents)
 
+class LexiconMatcher(object):
+    # A lexicon entry matches a tokenized description that contains all of
+    # its words; entries without words never match. Descriptions are encoded
+    # through a sparse (words, entries) incidence matrix, so a whole corpus
+    # takes one sparse product.
+    def __init__(self, lexicon, reverse_vocab):
+        entry_words = [set(reverse_vocab[w] for w in l) for l in lexicon]
+        words = sorted(set().union(*entry_words))
+        self.word_index = {w: i for i, w in enumerate(words)}
+        rows = [self.word_index[w] for e in entry_words for w in e]
+        cols = [i for i, e in enumerate(entry_words) for _ in e]
+        self.incidence = sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, cols)),
+                shape=(len(words), len(lexicon)))
+        self.entry_sizes = np.asarray([len(e) for e in entry_words])
+
+    # (descriptions, entries) boolean matrix of matches
+    def match(self, descs):
+        rows = []
+        cols = []
+        for i, tokens in enumerate(descs):
+            for token in set(tokens):
+                if token in self.word_index:
+                    rows.append(i)
+                    cols.append(self.word_index[token])
+        present = sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, cols)),
+                shape=(len(descs), self.incidence.shape[0]))
+        counts = present.dot(self.incidence).toarray()
+        return (counts == self.entry_sizes) & (self.entry_sizes > 0)
+
+    # matches normalized to sum to one per description; descriptions without
+    # any match get an all-zero row
+    def reps(self, descs):
+        matches = self.match(descs).astype(np.float64)
+        totals = np.sum(matches, axis=1, keepdims=True)
+        return matches / np.maximum(totals, 1)
+
 def flatten(lol):
     if isinstance(lol, tuple) or isinstance(lol, list):
         return sum([flatten(l) for l in lol], [])
@@ -0,0 +1,122 @@
+import multiprocessing
+import numpy as np
+
+RANDOM_NAMES = ("random", "randoms")
+
+def _work(task, offset, pipe):
+    task.reseed(offset)
+    batch = None
+    while True:
+        command = pipe.recv()
+        if command[0] == "reset":
+            _, fold, n = command
+            batch = task.get_batch(fold, n)
+            pipe.send(batch)
+        elif command[0] == "step":
+            _, actions, active = command
+            reward, stop = batch.step(actions, active)
+            # the caller keeps a copy of the batch, so only send what the
+            # step changed
+            pipe.send((reward, stop, batch.get_step_state()))
+        elif command[0] == "get_randoms":
+            pipe.send({
+                    name: getattr(task, name) for name in RANDOM_NAMES
+                    if hasattr(task, name)})
+        elif command[0] == "set_randoms":
+            for name, value in command[1].items():
+                setattr(task, name, value)
+        elif command[0] == "close":
+            pipe.close()
+            return
+        else:
+            assert False, "unknown command %s" % command[0]
+
+class RolloutWorkers(object):
+    # Each subprocess owns a slice of the rollout worlds and steps it with
+    # its own seeded copy of the task; policy inference stays with the
+    # caller. get_batch returns an object with the same interface as
+    # task.get_batch. Start the workers before creating a TF session, which
+    # must not be shared with forked children.
+    def __init__(self, task, n_workers):
+        self.pipes = []
+        self.processes = []
+        for i_worker in range(n_workers):
+            pipe, child_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                    target=_work, args=(task, i_worker + 1, child_pipe))
+            process.daemon = True
+            process.start()
+            child_pipe.close()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+
+    def get_batch(self, fold, n):
+        n_workers = len(self.pipes)
+        pipes = []
+        for i_worker, pipe in enumerate(self.pipes):
+            size = n // n_workers + (i_worker < n % n_workers)
+            if size == 0:
+                continue
+            pipe.send(("reset", fold, size))
+            pipes.append(pipe)
+        return WorkerBatch(pipes, [pipe.recv() for pipe in pipes])
+
+    # each worker task's RNGs, for snapshots
+    def get_randoms(self):
+        for pipe in self.pipes:
+            pipe.send(("get_randoms",))
+        return [pipe.recv() for pipe in self.pipes]
+
+    def set_randoms(self, randoms):
+        assert randoms is not None and len(randoms) == len(self.pipes), \
+                "snapshot has no RNGs for %d workers" % len(self.pipes)
+        for pipe, worker_randoms in zip(self.pipes, randoms):
+            pipe.send(("set_randoms", worker_randoms))
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.send(("close",))
+        for process in self.processes:
+            process.join()
+
+class WorkerBatch(object):
+    def __init__(self, pipes, batches):
+        self.pipes = pipes
+        # local copies of each worker's batch, brought up to date after
+        # every step
+        self.batches = batches
+        self.bounds = np.cumsum([0] + [len(b) for b in batches])
+
+    def __len__(self):
+        return self.bounds[-1]
+
+    @property
+    def l_msg(self):
+        parts = [b.l_msg for b in self.batches]
+        return tuple(np.concatenate(p) for p in zip(*parts))
+
+    def states(self):
+        return [s for b in self.batches for s in b.states()]
+
+    def obs(self):
+        parts = [b.obs() for b in self.batches]
+        return tuple(np.concatenate(p) for p in zip(*parts))
+
+    def obs_indices(self):
+        parts = [b.obs_indices() for b in self.batches]
+        return tuple(np.concatenate(p) for p in zip(*parts))
+
+    def step(self, actions, active=None):
+        if active is None:
+            active = np.ones(len(self), dtype=bool)
+        for pipe, start, end in zip(
+                self.pipes, self.bounds[:-1], self.bounds[1:]):
+            pipe.send(("step", actions[start:end], active[start:end]))
+        rewards = []
+        stops = []
+        for batch, pipe in zip(self.batches, self.pipes):
+            reward, stop, step_state = pipe.recv()
+            batch.set_step_state(step_state)
+            rewards.append(reward)
+            stops.append(stop)
+        return np.concatenate(rewards), np.concatenate(stops)
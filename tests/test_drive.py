@@ -0,0 +1,210 @@
+from tasks.drive import Car, DriveBatch, DriveTask
+
+import numpy as np
+import unittest
+
+N_INSTANCES = 500
+N_STEPS = 20
+
+# the occupancy-grid step that DriveState.step replaced, kept as a reference.
+# Also returns whether the step crashed and how many covered cells were off
+# the road.
+
+def grid_move(state, car, action):
+    nr, nc = car.pos
+    ndir = car.dir
+    turn = False
+    if action == 0:
+        pass
+    elif action == 1:
+        if car.dir == 0:
+            nr -= 1
+        elif car.dir == 1:
+            nc += 1
+        elif car.dir == 2:
+            nr += 1
+        elif car.dir == 3:
+            nc -= 1
+    elif action == 2:
+        ndir -= 1
+        turn = True
+    elif action == 3:
+        ndir += 1
+        turn = True
+    ndir %= 4
+
+    if turn:
+        if ndir == 0:
+            nr -= 1
+        elif ndir == 1:
+            nc += 1
+        elif ndir == 2:
+            nr += 1
+        elif ndir == 3:
+            nc -= 1
+
+    nr = min(nr, state.road.shape[0]-1)
+    nc = min(nc, state.road.shape[1]-1)
+    nr = max(nr, 0)
+    nc = max(nc, 0)
+
+    if car.done:
+        nr, nc = -1, -1
+
+    return Car((nr, nc), ndir, car.goal, car.done)
+
+def grid_step(state, actions):
+    road = state.road
+    ncars = [grid_move(state, c, a) for c, a in zip(state.cars, actions)]
+    occupied = np.zeros(road.shape)
+    for car in ncars:
+        if car.done:
+            continue
+        r2, c2 = car.pos
+        if car.dir == 0:
+            r2 += 1
+        elif car.dir == 1:
+            c2 -= 1
+        elif car.dir == 2:
+            r2 -= 1
+        elif car.dir == 3:
+            c2 += 1
+        occupied[car.pos] += 1
+        if 0 <= r2 < road.shape[0] and 0 <= c2 < road.shape[1]:
+            occupied[r2, c2] += 1
+
+    off = 0
+    crash = False
+    for r in range(road.shape[0]):
+        for c in range(road.shape[1]):
+            if occupied[r, c] > 0 and road[r, c] == 0:
+                off += 1
+            if occupied[r, c] > 1:
+                crash = True
+
+    final_cars = []
+    n_success = 0
+    n_improved = 0
+    for ocar, ncar in zip(state.cars, ncars):
+        if ncar.done:
+            final_cars.append(ncar)
+        elif ncar.pos == ncar.goal:
+            n_success += 1
+            final_cars.append(ncar._replace(done=True))
+        else:
+            old_dist = sum(abs(p-q) for p, q in zip(ocar.goal, ocar.pos))
+            new_dist = sum(abs(p-q) for p, q in zip(ncar.goal, ncar.pos))
+            n_improved += old_dist - new_dist
+            final_cars.append(ncar)
+
+    reward = 0
+    stop = False
+    if all(car.done for car in final_cars):
+        stop = True
+    if crash:
+        reward -= 2.0
+        stop = True
+    reward -= 0.01
+    reward -= 0.5 * off
+    reward += 1.0 * n_success
+    reward += 0.1 * n_improved
+    return final_cars, reward, stop, crash, off
+
+class DriveStepTest(unittest.TestCase):
+    def setUp(self):
+        self.task = DriveTask()
+
+    def check_step(self, state, actions):
+        cars, reward, stop, crash, off = grid_step(state, actions)
+        state_, new_reward, new_stop = state.step(actions)
+        self.assertEqual(cars, state_.cars)
+        self.assertEqual(reward, new_reward)
+        self.assertEqual(stop, new_stop)
+        return state_, crash, off
+
+    # random actions from seeded instances, run past crashes and off-road
+    # moves to also cover finished cars and cars pushed against the edges
+    def test_random_instances(self):
+        random = np.random.RandomState(0)
+        self.task.reseed(0)
+        n_crashes = 0
+        n_off = 0
+        n_done = 0
+        for _ in range(N_INSTANCES):
+            state = self.task.get_instance("train")
+            for _ in range(N_STEPS):
+                actions = tuple(random.randint(n) for n in self.task.n_actions)
+                state, crash, off = self.check_step(state, actions)
+                n_crashes += crash
+                n_off += off > 0
+                n_done += any(car.done for car in state.cars)
+        self.assertGreater(n_crashes, 0)
+        self.assertGreater(n_off, 0)
+        self.assertGreater(n_done, 0)
+
+    def test_demonstrations(self):
+        for demo in (
+                self.task.train_demonstrations
+                + self.task.test_demonstrations):
+            for e in demo:
+                _, reward, stop = e.s1.step(e.a)
+                self.assertEqual(reward, e.r)
+                self.assertEqual(stop, e.t)
+                self.check_step(e.s1, e.a)
+
+class DriveBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.task = DriveTask()
+
+    def check_batch(self, batch, states):
+        self.assertEqual(
+                [s.cars for s in batch.states()], [s.cars for s in states])
+        for i_car, obs in enumerate(batch.obs()):
+            np.testing.assert_array_equal(
+                    obs, [s.obs()[i_car] for s in states])
+
+    def check_step(self, batch, states, actions, active):
+        rewards, stops = batch.step(actions, active)
+        for i in np.flatnonzero(active):
+            states[i], reward, stop = states[i].step(tuple(actions[i]))
+            self.assertEqual(rewards[i], reward)
+            self.assertEqual(stops[i], stop)
+        self.assertFalse(np.any(rewards[~active]))
+        self.assertFalse(np.any(stops[~active]))
+        self.check_batch(batch, states)
+        return stops
+
+    # a batch and the same instances drawn one at a time, stepped with random
+    # actions; finished worlds stay inactive like in a rollout
+    def test_random_instances(self):
+        random = np.random.RandomState(0)
+        self.task.reseed(0)
+        batch = self.task.get_batch("train", N_INSTANCES)
+        self.task.reseed(0)
+        states = [
+                self.task.get_instance("train") for _ in range(N_INSTANCES)]
+        self.check_batch(batch, states)
+        done = np.zeros(N_INSTANCES, dtype=bool)
+        for _ in range(N_STEPS):
+            actions = np.stack([
+                    random.randint(n, size=N_INSTANCES)
+                    for n in self.task.n_actions], axis=1)
+            done |= self.check_step(batch, states, actions, ~done)
+        self.assertTrue(np.any(done))
+
+    def test_demonstrations(self):
+        experiences = [
+                e for demo in (
+                    self.task.train_demonstrations
+                    + self.task.test_demonstrations)
+                for e in demo]
+        states = [e.s1 for e in experiences]
+        batch = DriveBatch.from_states(self.task.roads, states)
+        self.check_batch(batch, states)
+        actions = np.asarray([e.a for e in experiences])
+        self.check_step(
+                batch, list(states), actions,
+                np.ones(len(experiences), dtype=bool))
+
+if __name__ == "__main__":
+    unittest.main()
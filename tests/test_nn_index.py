@@ -0,0 +1,30 @@
+from nn_index import top_k
+
+import numpy as np
+import unittest
+
+class TopKTest(unittest.TestCase):
+    def check(self, scores, k):
+        expected = np.argsort(scores, kind="mergesort")[:k]
+        np.testing.assert_array_equal(top_k(scores, k), expected)
+
+    def test_ties_at_boundary(self):
+        # the k-th lowest score is shared with rows on both sides of it
+        scores = np.array([3., 1., 2., 2., 0., 2., 5., 2.])
+        for k in range(1, len(scores) + 2):
+            self.check(scores, k)
+        self.check(-scores, 3)
+
+    def test_all_tied(self):
+        scores = np.zeros(20)
+        for k in (1, 7, 20):
+            self.check(scores, k)
+
+    def test_random_ties(self):
+        random = np.random.RandomState(0)
+        for _ in range(100):
+            scores = random.randint(5, size=random.randint(1, 40)) * 1.
+            self.check(scores, random.randint(1, len(scores) + 1))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+from prefetch import Prefetcher
+
+import threading
+import unittest
+
+class PrefetcherTest(unittest.TestCase):
+    def test_results_in_order(self):
+        prefetcher = Prefetcher(lambda item: item * 2, 3)
+        for item in range(3):
+            prefetcher.put(item)
+        self.assertEqual(prefetcher.n_pending, 3)
+        self.assertEqual([prefetcher.get() for _ in range(3)], [0, 2, 4])
+        self.assertEqual(prefetcher.n_pending, 0)
+        prefetcher.close()
+
+    def test_bounded(self):
+        built = []
+        prefetcher = Prefetcher(built.append, 2)
+        # two results waiting, one build blocked on handing its result over
+        # and two items queued
+        for item in range(5):
+            prefetcher.put(item)
+        full = threading.Thread(target=prefetcher.put, args=(5,))
+        full.daemon = True
+        full.start()
+        full.join(0.2)
+        self.assertTrue(full.is_alive())
+        self.assertEqual(built, [0, 1, 2])
+        prefetcher.get()
+        full.join(1)
+        self.assertFalse(full.is_alive())
+        prefetcher.close()
+        self.assertEqual(built, range(6))
+
+    def test_errors_raised_from_get(self):
+        def build(item):
+            if item == 1:
+                raise ValueError(item)
+            return item
+        prefetcher = Prefetcher(build, 2)
+        prefetcher.put(0)
+        prefetcher.put(1)
+        self.assertEqual(prefetcher.get(), 0)
+        self.assertRaises(ValueError, prefetcher.get)
+        prefetcher.close()
+
+if __name__ == "__main__":
+    unittest.main()
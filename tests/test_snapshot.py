@@ -0,0 +1,51 @@
+from experience import Experience, Episode
+from replay import ReplayMemory
+import snapshot
+from tasks.drive import DriveTask
+
+import numpy as np
+import shutil
+import tempfile
+import unittest
+
+N_EPISODES = 50
+N_STEPS = 10
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_experiences_round_trip(self):
+        task = DriveTask()
+        random = np.random.RandomState(0)
+        replay = ReplayMemory(N_EPISODES)
+        for _ in range(N_EPISODES):
+            world = task.get_instance("train")
+            experiences = []
+            for _ in range(N_STEPS):
+                actions = tuple(random.randint(n) for n in task.n_actions)
+                world_, reward, done = world.step(actions)
+                experiences.append(Experience(
+                    world, None, actions, world_, None, reward, done))
+                world = world_
+                if done:
+                    break
+            replay.append(Episode(experiences))
+        snapshot.save(self.directory + "/snap", task, replay, [], None)
+
+        replay2 = ReplayMemory(N_EPISODES)
+        snapshot.load(self.directory + "/snap", DriveTask(), replay2, [])
+        for episode, episode2 in zip(replay.episodes, replay2.episodes):
+            for e, e2 in zip(episode, episode2):
+                self.assertEqual(e.s1.key(), e2.s1.key())
+                self.assertEqual(e.s2.key(), e2.s2.key())
+                self.assertEqual(e.a, e2.a)
+                # rewards exactly, not through the float32 episode arrays
+                self.assertEqual(e.r, e2.r)
+                self.assertEqual(e.t, e2.t)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+from channels import GaussianChannel
+from experience import Experience, Episode, RolloutPlaceholders, \
+        ReplayPlaceholders
+from models import RecurrentQModel
+from tasks.drive import DriveTask
+from util import Struct
+
+import numpy as np
+import tensorflow as tf
+import unittest
+import yaml
+
+N_EPISODES = 8
+
+# RecurrentQModel on the dense and the (index, value) drive observations,
+# built in separate graphs that share weights
+
+def load_config():
+    with open("configs/drive_train.yaml") as config_f:
+        config = Struct(**yaml.load(config_f))
+    config.trainer.n_batch_episodes = N_EPISODES
+    # replayed Q-values see the previous step's transmitted messages
+    config.channel.std = 0.
+    return config
+
+def random_episodes(task, config, random):
+    episodes = []
+    for _ in range(N_EPISODES):
+        world = task.get_instance("train")
+        experiences = []
+        for t in range(config.trainer.n_batch_history):
+            actions = tuple(random.randint(n) for n in task.n_actions)
+            world_, reward, done = world.step(actions)
+            experiences.append(Experience(
+                world, None, actions, world_, None, reward, done))
+            world = world_
+            if done:
+                break
+        episodes.append(Episode(experiences))
+    return episodes
+
+def build_model(task, config, sparse):
+    config.model.sparse_obs = sparse
+    graph = tf.Graph()
+    with graph.as_default():
+        rollout_ph = RolloutPlaceholders(task, config)
+        replay_ph = ReplayPlaceholders(task, config)
+        channel = GaussianChannel()
+        channel.build(config)
+        model = RecurrentQModel()
+        model.build(task, rollout_ph, replay_ph, channel, config)
+        session = tf.Session(graph=graph)
+        session.run(tf.global_variables_initializer())
+    return graph, session, rollout_ph, replay_ph, model
+
+def copy_variables(source, target):
+    source_graph, source_session = source
+    target_graph, target_session = target
+    with source_graph.as_default():
+        values = {
+                v.name: value for v, value in zip(
+                    tf.global_variables(),
+                    source_session.run(tf.global_variables()))}
+    with target_graph.as_default():
+        target_session.run([
+                v.assign(values[v.name]) for v in tf.global_variables()])
+
+class SparseObsTest(unittest.TestCase):
+    def setUp(self):
+        self.config = load_config()
+        self.task = DriveTask()
+        random = np.random.RandomState(0)
+        self.episodes = random_episodes(self.task, self.config, random)
+        self.worlds = self.task.get_batch("train", N_EPISODES)
+        self.memory = tuple(
+                tuple(random.randn(N_EPISODES, size).astype(np.float32)
+                    for _ in range(self.task.n_agents))
+                for size in (self.config.model.n_hidden,
+                    self.config.channel.n_msg, self.config.model.n_hidden))
+        self.dense = build_model(self.task, self.config, False)
+        self.sparse = build_model(self.task, self.config, True)
+        copy_variables(self.dense[:2], self.sparse[:2])
+
+    def tearDown(self):
+        self.dense[1].close()
+        self.sparse[1].close()
+
+    def test_rollout_q(self):
+        outputs = []
+        for built in (self.dense, self.sparse):
+            _, session, rollout_ph, _, model = built
+            hs, zs, l_hs = self.memory
+            outputs.append(session.run(
+                    [model.tt_rollout_h, model.tt_rollout_q],
+                    rollout_ph.feed(
+                        hs, zs, l_hs, self.worlds, self.task, self.config)))
+        for dense, sparse in zip(*outputs):
+            for i_agent in range(self.task.n_agents):
+                np.testing.assert_allclose(
+                        dense[i_agent], sparse[i_agent], atol=1e-5)
+
+    def test_replay_td(self):
+        outputs = []
+        for built in (self.dense, self.sparse):
+            _, session, _, replay_ph, model = built
+            feed = replay_ph.feed(self.episodes, self.task, self.config)
+            outputs.append(session.run([model.t_loss, model.t_slice_td], feed))
+            # and again after a training step on the same batch
+            session.run(model.t_train_op, feed)
+            outputs.append(session.run([model.t_loss, model.t_slice_td], feed))
+        dense_outputs, sparse_outputs = outputs[:2], outputs[2:]
+        for dense, sparse in zip(dense_outputs, sparse_outputs):
+            np.testing.assert_allclose(dense[0], sparse[0], rtol=1e-4)
+            np.testing.assert_allclose(
+                    dense[1], sparse[1], rtol=1e-4, atol=1e-5)
+
+if __name__ == "__main__":
+    unittest.main()